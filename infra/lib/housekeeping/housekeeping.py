@@ -2,6 +2,7 @@ import boto3
 import os
 from botocore.exceptions import ClientError
 import logging
+from datetime import datetime, timedelta, timezone
 
 dynamodb_client = boto3.client('dynamodb')
 s3_client = boto3.client('s3')
@@ -32,7 +33,8 @@ def get_latest_version(domain_name: str) -> dict:
                 'domainName': item['domainName']['S'],
                 's3Path': item['s3Path']['S'],
                 'version': int(item['version']['N']),
-                's3VersionId': item['s3VersionId']['S']
+                's3VersionId': item['s3VersionId']['S'],
+                'deltas': [delta['S'] for delta in item.get('deltas', {}).get('L', [])]
             }
         else:
             logger.debug("No items found")
@@ -42,19 +44,44 @@ def get_latest_version(domain_name: str) -> dict:
         raise
 
 
-def purge_old_versions(upto_version: str) -> dict:
+def get_retained_deltas(domain_name: str, keep_versions: list) -> list:
+    """Deltas referenced by any version built on a base snapshot that is kept."""
+    deltas = set()
+    try:
+        paginator = dynamodb_client.get_paginator('query')
+        for page in paginator.paginate(
+                TableName=table_name,
+                KeyConditionExpression='domainName = :domainName',
+                ExpressionAttributeValues={':domainName': {'S': domain_name}},
+                ProjectionExpression='s3VersionId, deltas'):
+            for item in page.get('Items', []):
+                if item.get('s3VersionId', {}).get('S') in keep_versions:
+                    deltas.update(delta['S'] for delta in item.get('deltas', {}).get('L', []))
+    except Exception as e:
+        logger.error(f"Error querying DynamoDB: {str(e)}")
+        raise
+    return sorted(deltas)
+
+
+def purge_old_versions(upto_version: str, object_key='db.sqlite3') -> list:
     try:
         result = s3_client.list_object_versions(
-            Bucket=bucket_name, Prefix='db.sqlite3')
+            Bucket=bucket_name, Prefix=object_key)
         num_to_keep = 10
         num_kept = 0
         delete_versions = []
+        keep_versions = []
         for version in result['Versions']:
+            if version['Key'] != object_key:
+                # deltas, block indexes and the churn file share the prefix
+                continue
             if version['IsLatest'] or version['VersionId'] == upto_version:
                 print('Retaining' + str(version))
+                keep_versions.append(version['VersionId'])
             else:
                 if num_kept < num_to_keep:
                     print('Retaining' + str(version))
+                    keep_versions.append(version['VersionId'])
                     num_kept = num_kept + 1
                 else:
                     print('Deleting' + str(version))
@@ -78,13 +105,74 @@ def purge_old_versions(upto_version: str) -> dict:
         raise Exception(
             "Unexpected error in list_all_objects_version function of s3 helper: " + e.__str__())
 
-    return
+    return keep_versions
+
+
+def purge_unreferenced_indexes(keep_versions: list, object_key='db.sqlite3') -> None:
+    # Block indexes (<object key>.index/<version id>) are only useful while
+    # their snapshot version still exists.
+    delete_indexes = []
+    try:
+        paginator = s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=f'{object_key}.index/'):
+            for index in page.get('Contents', []):
+                if index['Key'].split('/', 1)[1] not in keep_versions:
+                    delete_indexes.append({'Key': index['Key']})
+
+        for i in range(0, len(delete_indexes), 1000):
+            print('Deleting indexes:', delete_indexes[i:i + 1000])
+            s3_client.delete_objects(
+                Bucket=bucket_name,
+                Delete={'Objects': delete_indexes[i:i + 1000]}
+            )
+
+    except ClientError as e:
+        raise Exception(
+            "boto3 client error in purge_unreferenced_indexes function: " + e.__str__())
+
+
+def purge_unreferenced_deltas(keep_deltas: list) -> None:
+    # Deltas no version on a retained base references are garbage, the
+    # retained bases keep theirs so they can still be rebuilt to every
+    # committed version. Recent ones are left alone as a writer may not have
+    # committed its version yet.
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=1)
+    delete_deltas = []
+    try:
+        paginator = s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket_name, Prefix='db.sqlite3.deltas/'):
+            for delta in page.get('Contents', []):
+                if delta['Key'] in keep_deltas or delta['LastModified'] > cutoff:
+                    print('Retaining' + str(delta))
+                else:
+                    delete_deltas.append({'Key': delta['Key']})
+
+        # delete_objects accepts at most 1000 keys per call
+        for i in range(0, len(delete_deltas), 1000):
+            print('Deleting deltas:', delete_deltas[i:i + 1000])
+            s3_client.delete_objects(
+                Bucket=bucket_name,
+                Delete={'Objects': delete_deltas[i:i + 1000]}
+            )
+        if not delete_deltas:
+            print('No deltas to delete.')
+
+    except ClientError as e:
+        raise Exception(
+            "boto3 client error in purge_unreferenced_deltas function: " + e.__str__())
 
 
 def handler(event, context):
     latest = get_latest_version('example.com')
     print(latest)
-    purge_old_versions(latest['s3VersionId'])
+    keep_versions = purge_old_versions(latest['s3VersionId'])
+    purge_unreferenced_indexes(keep_versions)
+    purge_unreferenced_deltas(get_retained_deltas('example.com', keep_versions))
+    # Churn tables have their own chain (SNAPSHOT_CHURN_DB)
+    latest_churn = get_latest_version('example.com#churn')
+    if latest_churn:
+        keep_versions = purge_old_versions(latest_churn['s3VersionId'], latest_churn['s3Path'])
+        purge_unreferenced_indexes(keep_versions, latest_churn['s3Path'])
     pass
 
 
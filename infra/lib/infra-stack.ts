@@ -10,6 +10,8 @@ import * as python from "@aws-cdk/aws-lambda-python-alpha";
 import { LambdaRestApi } from "aws-cdk-lib/aws-apigateway";
 import * as s3 from "aws-cdk-lib/aws-s3";
 import * as dynamodb from "aws-cdk-lib/aws-dynamodb";
+import * as sqs from "aws-cdk-lib/aws-sqs";
+import { SqsEventSource } from "aws-cdk-lib/aws-lambda-event-sources";
 import path = require("path");
 
 interface InfraStackProps extends cdk.StackProps {
@@ -45,6 +47,7 @@ export class InfraStack extends cdk.Stack {
         name: "session_key",
         type: dynamodb.AttributeType.STRING,
       },
+      timeToLiveAttribute: "expires",
     });
 
     const fn = new lambda.Function(this, `DjangoServerless`, {
@@ -60,6 +63,7 @@ export class InfraStack extends cdk.Stack {
         TABLE_NAME: versionTable.tableName,
         DJANGO_LOG_LEVEL: "DEBUG",
         DYNAMODB_SESSIONS_TABLE_NAME: sessionsTable.tableName,
+        STATIC_EXPORT_PREFIX: "static-pages",
         DEBUG: "False",
       },
     });
@@ -136,6 +140,30 @@ export class InfraStack extends cdk.Stack {
     versionTable.grantReadWriteData(fn);
     sessionsTable.grantReadWriteData(fn); // todo restrict
 
+    // Queued write events are applied in batches, one snapshot upload each
+    const writeQueue = new sqs.Queue(this, `WriteQueue`, {
+      visibilityTimeout: cdk.Duration.seconds(300),
+      // Records that keep failing (e.g. a job for an image deleted since)
+      // stop being redelivered after a few attempts
+      deadLetterQueue: {
+        queue: new sqs.Queue(this, `WriteDeadLetterQueue`, {
+          retentionPeriod: cdk.Duration.days(14),
+        }),
+        maxReceiveCount: 5,
+      },
+    });
+    fn.addEventSource(
+      new SqsEventSource(writeQueue, {
+        batchSize: 10,
+        maxBatchingWindow: cdk.Duration.seconds(5),
+        reportBatchItemFailures: true,
+      })
+    );
+    // The app queues its own background jobs there too (cms.renditions,
+    // page refreshes from cms.models)
+    writeQueue.grantSendMessages(fn);
+    fn.addEnvironment("WRITE_QUEUE_URL", writeQueue.queueUrl);
+
     this.bucket.grantReadWrite(fn);
 
     const origin = new origins.HttpOrigin(
@@ -159,10 +187,42 @@ export class InfraStack extends cdk.Stack {
 
     this.bucket.grantRead(originAccessIdentity);
 
+    // Published pages are exported to the bucket (cms.static_export) and
+    // served from there, Lambda only renders the paths that have no object
+    const staticPages = new origins.S3Origin(this.bucket, {
+      originAccessIdentity: originAccessIdentity,
+      originPath: "/static-pages",
+    });
+
+    const pages = new origins.OriginGroup({
+      primaryOrigin: staticPages,
+      fallbackOrigin: origin,
+      // S3 answers 403 for missing keys without ListBucket
+      fallbackStatusCodes: [403, 404],
+    });
+
+    const lambdaBehavior: cloudfront.BehaviorOptions = {
+      origin: origin,
+      allowedMethods: cloudfront.AllowedMethods.ALLOW_ALL,
+      viewerProtocolPolicy: cloudfront.ViewerProtocolPolicy.HTTPS_ONLY,
+      cachePolicy: cloudfront.CachePolicy.CACHING_OPTIMIZED,
+      originRequestPolicy:
+        cloudfront.OriginRequestPolicy.ALL_VIEWER_EXCEPT_HOST_HEADER,
+    };
+
+    // App endpoints (cms.urls) vary by query string, e.g. the recipe catalog
+    const appCachePolicy = new cloudfront.CachePolicy(this, `AppCachePolicy`, {
+      queryStringBehavior: cloudfront.CacheQueryStringBehavior.all(),
+      enableAcceptEncodingGzip: true,
+      enableAcceptEncodingBrotli: true,
+    });
+
     const distribution = new cloudfront.Distribution(this, `MyDist`, {
       defaultBehavior: {
-        origin: origin,
-        allowedMethods: cloudfront.AllowedMethods.ALLOW_ALL,
+        origin: pages,
+        // Origin groups only fail over reads, everything posting has its
+        // own behavior below
+        allowedMethods: cloudfront.AllowedMethods.ALLOW_GET_HEAD_OPTIONS,
         viewerProtocolPolicy: cloudfront.ViewerProtocolPolicy.HTTPS_ONLY,
         cachePolicy: cloudfront.CachePolicy.CACHING_OPTIMIZED,
         originRequestPolicy:
@@ -181,6 +241,13 @@ export class InfraStack extends cdk.Stack {
           originRequestPolicy:
             cloudfront.OriginRequestPolicy.ALL_VIEWER_EXCEPT_HOST_HEADER,
         },
+        "/cms/*": lambdaBehavior,
+        "/admin/*": lambdaBehavior,
+        "/myapp/*": { ...lambdaBehavior, cachePolicy: appCachePolicy },
+        "/documents/*": lambdaBehavior,
+        "/static/*": lambdaBehavior,
+        // Password protected pages post here
+        "/_util/*": lambdaBehavior,
       },
       enableLogging: true,
     });
@@ -205,6 +272,34 @@ export class InfraStack extends cdk.Stack {
 
     fn.addToRolePolicy(invalidationPolicy);
 
+    // Publishes queue the paths to invalidate, a burst of them is merged into
+    // a few invalidations (lib/invalidation)
+    const invalidationQueue = new sqs.Queue(this, `InvalidationQueue`, {
+      visibilityTimeout: cdk.Duration.seconds(60),
+    });
+
+    const invalidationLambda = new lambda.Function(this, "InvalidationLambda", {
+      runtime: lambda.Runtime.PYTHON_3_9,
+      handler: "invalidation.handler",
+      memorySize: 256,
+      timeout: cdk.Duration.seconds(30),
+      code: lambda.Code.fromAsset(path.join(__dirname, "invalidation")),
+      environment: {
+        DISTRIBUTION_ID: distribution.distributionId,
+      },
+    });
+
+    invalidationLambda.addToRolePolicy(invalidationPolicy);
+    invalidationLambda.addEventSource(
+      new SqsEventSource(invalidationQueue, {
+        batchSize: 1000,
+        maxBatchingWindow: cdk.Duration.seconds(30),
+      })
+    );
+
+    invalidationQueue.grantSendMessages(fn);
+    fn.addEnvironment("INVALIDATION_QUEUE_URL", invalidationQueue.queueUrl);
+
     // Define the migration Lambda function with the pre-created role
     this.migrationLambda = new lambda.Function(this, "MigrationLambda", {
       tracing: lambda.Tracing.ACTIVE,
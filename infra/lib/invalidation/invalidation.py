@@ -0,0 +1,71 @@
+import hashlib
+import json
+import logging
+import os
+
+import boto3
+
+cloudfront_client = boto3.client('cloudfront')
+distribution_id = os.environ['DISTRIBUTION_ID']
+
+# Above this many distinct paths a single wildcard is cheaper, CloudFront
+# bills each path (wildcards included) of an invalidation
+MAX_PATHS = int(os.environ.get('INVALIDATION_MAX_PATHS', 100))
+# CloudFront's limit of paths per invalidation
+BATCH_SIZE = 3000
+
+logger = logging.getLogger()
+logger.setLevel("INFO")
+
+
+def get_paths(records) -> set:
+    paths = set()
+    for record in records:
+        paths.update(json.loads(record['body'])['paths'])
+    return paths
+
+
+def is_covered(path, wildcards) -> bool:
+    return any(path.startswith(wildcard[:-1]) for wildcard in wildcards if wildcard != path)
+
+
+def minimize_paths(paths) -> list:
+    """Drop duplicates and paths covered by a wildcard, collapse to /* if too many."""
+    wildcards = [path for path in paths if path.endswith('*')]
+    paths = sorted(path for path in paths if not is_covered(path, wildcards))
+    if len(paths) > MAX_PATHS:
+        return ['/*']
+    return paths
+
+
+def invalidate(paths, caller_reference):
+    response = cloudfront_client.create_invalidation(
+        DistributionId=distribution_id,
+        InvalidationBatch={
+            'Paths': {
+                'Quantity': len(paths),
+                'Items': paths
+            },
+            'CallerReference': caller_reference
+        }
+    )
+    logger.info(f"Invalidation {response['Invalidation']['Id']} of {len(paths)} paths")
+
+
+def handler(event, context):
+    """Merge the invalidations queued by a burst of publishes into as few as possible."""
+    records = event.get('Records', [])
+    paths = minimize_paths(get_paths(records))
+    logger.info(f"{len(records)} queued invalidations, {len(paths)} paths")
+    # Derived from the messages, so a retried batch doesn't invalidate twice
+    message_ids = hashlib.sha1(
+        ''.join(sorted(record['messageId'] for record in records)).encode()).hexdigest()
+    for start in range(0, len(paths), BATCH_SIZE):
+        invalidate(paths[start:start + BATCH_SIZE], f'{message_ids}-{start}')
+
+
+if __name__ == '__main__':
+    handler({'Records': [
+        {'messageId': '1', 'body': json.dumps({'paths': ['/', '/recipes/soup/']})},
+        {'messageId': '2', 'body': json.dumps({'paths': ['/', '/shopping-list/']})},
+    ]}, {})
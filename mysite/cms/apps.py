@@ -4,3 +4,13 @@ from django.apps import AppConfig
 class CmsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'cms'
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+        from mysite.churn import attach_churn_db
+        connection_created.connect(attach_churn_db)
+
+        from django.db.models.signals import post_save
+        from wagtail.images import get_image_model
+        from .renditions import generate_renditions_on_save
+        post_save.connect(generate_renditions_on_save, sender=get_image_model())
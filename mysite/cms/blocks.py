@@ -1,5 +1,10 @@
 from wagtail import blocks
 from wagtail.images.blocks import ImageChooserBlock
+from .renditions import register_rendition_filter
+
+# Header images as the header templates render them
+HEADER_IMAGE_FILTER = 'original'
+register_rendition_filter(HEADER_IMAGE_FILTER)
 
 class HeaderStyle1Block(blocks.StructBlock):
     title = blocks.CharBlock(required=True, max_length=100)
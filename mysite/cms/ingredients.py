@@ -0,0 +1,148 @@
+"""
+Parsing of a recipe's rich text ingredients into (name, quantity, unit) rows.
+
+Lines are taken the way the shopping list used to in the browser: every
+item of a top level list, every other top level block (split on <br>) as
+one line. A leading quantity ('2', '1.5', '1,000', '1 1/2', '½') and a
+known unit are split off (kilos and litres converted to grams and
+millilitres), the rest, lowercased and without descriptions after a comma
+or in brackets ('garlic, minced', 'leeks (sliced)'), is the name lines are
+merged on. Quantities too large to store are dropped.
+
+Names are also split into terms for the inverted index of recipes by
+ingredient: lowercased words, singular, without descriptions like 'chopped'.
+"""
+import re
+from decimal import Decimal, InvalidOperation
+from fractions import Fraction
+
+from bs4 import BeautifulSoup, NavigableString
+
+VULGAR_FRACTIONS = {
+    '¼': Fraction(1, 4), '½': Fraction(1, 2), '¾': Fraction(3, 4),
+    '⅓': Fraction(1, 3), '⅔': Fraction(2, 3), '⅛': Fraction(1, 8),
+}
+
+# Spellings of a unit, normalised to the first
+UNITS = [
+    ['g', 'gram', 'grams', 'gr'],
+    ['kg', 'kilogram', 'kilograms', 'kilo', 'kilos'],
+    ['ml', 'millilitre', 'millilitres', 'milliliter', 'milliliters'],
+    ['l', 'litre', 'litres', 'liter', 'liters'],
+    ['tsp', 'teaspoon', 'teaspoons', 'tsps'],
+    ['tbsp', 'tablespoon', 'tablespoons', 'tbsps', 'tbs'],
+    ['cup', 'cups'],
+    ['oz', 'ounce', 'ounces'],
+    ['lb', 'lbs', 'pound', 'pounds'],
+    ['pinch', 'pinches'],
+    ['handful', 'handfuls'],
+    ['clove', 'cloves'],
+    ['can', 'cans', 'tin', 'tins'],
+    ['bunch', 'bunches'],
+]
+UNIT_NAMES = {spelling: spellings[0] for spellings in UNITS for spelling in spellings}
+# Stored in the smaller unit so kilos and grams of the same thing merge
+CONVERSIONS = {'kg': ('g', 1000), 'l': ('ml', 1000)}
+
+# Words describing an ingredient rather than naming it
+STOP_WORDS = {
+    'a', 'an', 'and', 'as', 'at', 'for', 'in', 'of', 'or', 'the', 'to', 'with',
+    'chopped', 'crushed', 'diced', 'finely', 'fresh', 'freshly', 'grated', 'large',
+    'medium', 'minced', 'optional', 'peeled', 'roughly', 'sliced', 'small', 'taste',
+}
+WORD = re.compile(r'[^\W\d_]+')
+
+# Largest quantity RecipeIngredient.quantity (12 digits, 3 decimal) holds
+MAX_QUANTITY = Decimal('999999999.999')
+
+QUANTITY = re.compile(
+    r'^(?P<whole>\d{1,3}(?:,\d{3})+(?:\.\d+)?(?!\d)|\d+(?:[.,]\d+)?)?\s*(?P<fraction>\d+/\d+|[%s])?(?=\s|[a-z]|$)\s*'
+    % ''.join(VULGAR_FRACTIONS),
+    re.IGNORECASE)
+# Digits grouped by commas, '1,000' rather than the decimal comma of '1,5'
+GROUPED_DIGITS = re.compile(r'\d{1,3}(?:,\d{3})+(?:\.\d+)?')
+UNIT = re.compile(r'^(?P<unit>[a-z]+)\.?(?:\s+of)?\b\s*', re.IGNORECASE)
+# Descriptions of an ingredient after its name, 'garlic, minced' or 'leeks (sliced)'
+DESCRIPTION = re.compile(r'\([^)]*(?:\)|$)|,.*$')
+
+
+def get_lines(html) -> list:
+    """Ingredient lines of rich text, in order."""
+    lines = []
+    for node in BeautifulSoup(html or '', 'html.parser').children:
+        if isinstance(node, NavigableString):
+            texts = [node]
+        elif node.name in ('ul', 'ol'):
+            texts = [item.get_text(' ') for item in node.find_all('li')]
+        else:
+            for br in node.find_all('br'):
+                br.replace_with('\n')
+            texts = node.get_text(' ').split('\n')
+        lines += [' '.join(text.split()) for text in texts if text.strip()]
+    return lines
+
+
+def parse_quantity(match):
+    whole, fraction = match.group('whole'), match.group('fraction')
+    if whole is None and fraction is None:
+        return None
+    quantity = Fraction(0)
+    try:
+        if whole is not None:
+            if GROUPED_DIGITS.fullmatch(whole):
+                whole = whole.replace(',', '')
+            quantity += Fraction(Decimal(whole.replace(',', '.')))
+        if fraction is not None:
+            quantity += VULGAR_FRACTIONS.get(fraction) or Fraction(fraction)
+    except (InvalidOperation, ValueError, ZeroDivisionError):
+        return None
+    return Decimal(quantity.numerator) / Decimal(quantity.denominator)
+
+
+def get_name(text) -> str:
+    return ' '.join(text.lower().strip(' ,.-').split())
+
+
+def parse_line(line) -> dict:
+    """{'name', 'quantity', 'unit'} of one line, quantity None and unit '' if absent."""
+    rest = line
+    match = QUANTITY.match(rest)
+    quantity = parse_quantity(match) if match else None
+    unit = ''
+    if quantity is not None:
+        rest = rest[match.end():]
+        unit_match = UNIT.match(rest)
+        if unit_match and unit_match.group('unit').lower() in UNIT_NAMES:
+            unit = UNIT_NAMES[unit_match.group('unit').lower()]
+            rest = rest[unit_match.end():]
+    name = get_name(DESCRIPTION.sub(' ', rest)) or get_name(rest) or line.lower()
+    if unit in CONVERSIONS:
+        unit, factor = CONVERSIONS[unit]
+        quantity *= factor
+    if quantity is not None and quantity > MAX_QUANTITY:
+        # Not a real amount, and saving it would fail
+        quantity, unit = None, ''
+    if quantity is not None:
+        quantity = quantity.quantize(Decimal('0.001'))
+    return {'name': name, 'quantity': quantity, 'unit': unit}
+
+
+def parse_ingredients(html) -> list:
+    return [dict(parse_line(line), text=line) for line in get_lines(html)]
+
+
+def normalize_term(word) -> str:
+    """Singular, lowercase form of a word, 'Tomatoes' -> 'tomato'."""
+    word = word.lower()
+    if len(word) > 4 and word.endswith('ies'):
+        return f'{word[:-3]}y'
+    if len(word) > 4 and word.endswith(('oes', 'ches', 'shes', 'sses', 'xes')):
+        return word[:-2]
+    if len(word) > 3 and word.endswith('s') and not word.endswith(('ss', 'us', 'is')):
+        return word[:-1]
+    return word
+
+
+def get_terms(text) -> set:
+    """Index terms of an ingredient name or of a search."""
+    return {normalize_term(word) for word in WORD.findall(text.lower()) if word not in STOP_WORDS}
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from wagtail.images import get_image_model
+
+from cms.renditions import backfill_renditions
+
+
+class Command(BaseCommand):
+    help = 'Generate the registered renditions of every image, on the write queue if there is one.'
+
+    def handle(self, *args, **options):
+        image_ids = get_image_model().objects.order_by('id').values_list('id', flat=True)
+        backfill_renditions(image_ids)
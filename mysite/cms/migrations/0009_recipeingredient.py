@@ -0,0 +1,45 @@
+# Generated by Django 4.2.13 on 2026-10-18 19:16
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from cms.ingredients import parse_ingredients
+
+
+def parse_live_recipes(apps, schema_editor):
+    """Rows for recipes published before ingredients were parsed on publish."""
+    RecipePage = apps.get_model('cms', 'RecipePage')
+    RecipeIngredient = apps.get_model('cms', 'RecipeIngredient')
+    RecipeIngredient.objects.bulk_create([
+        RecipeIngredient(recipe=recipe, position=position, text=row['text'][:255],
+                         name=row['name'][:255], quantity=row['quantity'], unit=row['unit'])
+        for recipe in RecipePage.objects.filter(live=True)
+        for position, row in enumerate(parse_ingredients(recipe.ingredients))
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cms', '0008_shoppinglistpage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecipeIngredient',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveIntegerField()),
+                ('text', models.CharField(max_length=255)),
+                ('name', models.CharField(max_length=255)),
+                ('quantity', models.DecimalField(blank=True, decimal_places=3, max_digits=12, null=True)),
+                ('unit', models.CharField(blank=True, max_length=16)),
+                ('recipe', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ingredient_rows', to='cms.recipepage')),
+            ],
+            options={
+                'ordering': ['recipe', 'position'],
+                'indexes': [models.Index(fields=['name', 'unit'], name='cms_recipei_name_63e92f_idx')],
+            },
+        ),
+        migrations.RunPython(parse_live_recipes, migrations.RunPython.noop),
+    ]
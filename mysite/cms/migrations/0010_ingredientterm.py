@@ -0,0 +1,40 @@
+# Generated by Django 4.2.13 on 2026-10-18 19:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from cms.ingredients import get_terms
+
+
+def index_live_recipes(apps, schema_editor):
+    RecipeIngredient = apps.get_model('cms', 'RecipeIngredient')
+    IngredientTerm = apps.get_model('cms', 'IngredientTerm')
+    terms = {
+        (term[:64], recipe_id)
+        for recipe_id, name in RecipeIngredient.objects.filter(recipe__live=True).values_list('recipe_id', 'name')
+        for term in get_terms(name)
+    }
+    IngredientTerm.objects.bulk_create([IngredientTerm(term=term, recipe_id=recipe_id) for term, recipe_id in terms])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cms', '0009_recipeingredient'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngredientTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=64)),
+                ('recipe', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='cms.recipepage')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='ingredientterm',
+            constraint=models.UniqueConstraint(fields=('term', 'recipe'), name='cms_ingredientterm_term_recipe'),
+        ),
+        migrations.RunPython(index_live_recipes, migrations.RunPython.noop),
+    ]
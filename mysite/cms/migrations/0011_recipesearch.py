@@ -0,0 +1,33 @@
+from django.db import migrations
+
+from cms.search import index_recipe
+
+
+def index_live_recipes(apps, schema_editor):
+    RecipePage = apps.get_model('cms', 'RecipePage')
+    for recipe in RecipePage.objects.filter(live=True):
+        index_recipe(recipe)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cms', '0010_ingredientterm'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            # Porter stemmed, so 'tomatoes' finds 'tomato', with prefix
+            # indexes for 2 and 3 character prefixes of words being typed
+            "CREATE VIRTUAL TABLE cms_recipesearch USING fts5("
+            "title, introduction, ingredients, instructions, "
+            "tokenize = 'porter unicode61 remove_diacritics 2', prefix = '2 3')",
+            "DROP TABLE cms_recipesearch",
+        ),
+        migrations.RunSQL(
+            "CREATE TRIGGER cms_recipesearch_delete AFTER DELETE ON cms_recipepage BEGIN "
+            "DELETE FROM cms_recipesearch WHERE rowid = OLD.page_ptr_id; END",
+            "DROP TRIGGER cms_recipesearch_delete",
+        ),
+        migrations.RunPython(index_live_recipes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+import os
+
+from django.db import migrations
+
+from cms.renditions import backfill_renditions
+
+
+def queue_backfill(apps, schema_editor):
+    # Locally the missing renditions are generated as pages render them
+    if 'WRITE_QUEUE_URL' not in os.environ:
+        return
+    Image = apps.get_model('wagtailimages', 'Image')
+    backfill_renditions(Image.objects.order_by('id').values_list('id', flat=True))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cms', '0011_recipesearch'),
+        ('wagtailimages', '0026_delete_uploadedimage'),
+    ]
+
+    operations = [
+        migrations.RunPython(queue_backfill, migrations.RunPython.noop),
+    ]
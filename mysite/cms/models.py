@@ -1,10 +1,21 @@
-from django.db import models
-from wagtail.models import Page
+from datetime import datetime, timezone
+from html import unescape
+from django.db import models, transaction
+from django.db.models import Exists, OuterRef, Prefetch, Q
+from django.http import Http404
+from django.urls import reverse
+from django.utils.html import strip_tags
+from django.utils.text import Truncator
+from wagtail.contrib.routable_page.models import RoutablePageMixin, re_path
+from wagtail.models import Page, Site
 from wagtail.fields import StreamField, RichTextField
 from wagtail.admin.panels import FieldPanel
 from wagtail import blocks
 from wagtail.images.models import Image
 from .blocks import HeaderBlock
+from .ingredients import get_terms, parse_ingredients
+from .renditions import get_all_responsive_filters
+from . import search
 import boto3
 import os
 import time
@@ -25,35 +36,188 @@ class RecipePage(Page):
         FieldPanel('image'),
     ]
 
-class HomePage(Page):
+    def get_listing_pages(self):
+        """Live pages rendering this recipe, see their get_context."""
+        # The home page lists its own children
+        return list(HomePage.objects.live().filter(id=self.get_parent().id))
+
+    def save(self, *args, **kwargs):
+        # Searchable in the same transaction the live content changes in,
+        # draft saves only touch revision fields and are skipped
+        update_fields = kwargs.get('update_fields')
+        with transaction.atomic():
+            result = super().save(*args, **kwargs)
+            if update_fields is None or SEARCH_FIELDS.intersection(update_fields):
+                search.index_recipe(self)
+        return result
+
+# Fields of a recipe in the search index, see cms.search
+SEARCH_FIELDS = {'title', 'introduction', 'ingredients', 'instructions', 'live'}
+
+class RecipeIngredient(models.Model):
+    """One line of a recipe's published ingredients, parsed by cms.ingredients."""
+    recipe = models.ForeignKey(RecipePage, on_delete=models.CASCADE, related_name='ingredient_rows')
+    position = models.PositiveIntegerField()
+    text = models.CharField(max_length=255)
+    name = models.CharField(max_length=255)
+    quantity = models.DecimalField(max_digits=12, decimal_places=3, null=True, blank=True)
+    unit = models.CharField(max_length=16, blank=True)
+
+    class Meta:
+        ordering = ['recipe', 'position']
+        indexes = [models.Index(fields=['name', 'unit'])]
+
+def update_ingredient_rows(recipe):
+    """Replace the recipe's ingredient rows with those of its ingredients now."""
+    rows = [
+        RecipeIngredient(recipe=recipe, position=position, text=row['text'][:255],
+                         name=row['name'][:255], quantity=row['quantity'], unit=row['unit'])
+        for position, row in enumerate(parse_ingredients(recipe.ingredients))
+    ]
+    with transaction.atomic():
+        RecipeIngredient.objects.filter(recipe=recipe).delete()
+        RecipeIngredient.objects.bulk_create(rows)
+        update_ingredient_terms(recipe, set().union(*(get_terms(row.name) for row in rows)))
+
+class IngredientTerm(models.Model):
+    """Inverted index of live recipes by ingredient term, see cms.ingredients.get_terms."""
+    term = models.CharField(max_length=64)
+    recipe = models.ForeignKey(RecipePage, on_delete=models.CASCADE, related_name='+')
+
+    class Meta:
+        constraints = [
+            # Doubles as the (term, recipe) index lookups are answered from
+            models.UniqueConstraint(fields=['term', 'recipe'], name='cms_ingredientterm_term_recipe'),
+        ]
+
+def update_ingredient_terms(recipe, terms):
+    """Index recipe under terms, changing only the terms that differ."""
+    terms = {term[:64] for term in terms}
+    indexed = set(IngredientTerm.objects.filter(recipe=recipe).values_list('term', flat=True))
+    if indexed - terms:
+        IngredientTerm.objects.filter(recipe=recipe, term__in=indexed - terms).delete()
+    IngredientTerm.objects.bulk_create([IngredientTerm(term=term, recipe=recipe) for term in terms - indexed])
+
+def get_recipe_ids_with_ingredients(ingredients, match_all=True):
+    """
+    Ids of live recipes with all (or any) of the ingredients, as a subquery
+    answered from the term index alone.
+    """
+    terms = set().union(*(get_terms(ingredient) for ingredient in ingredients))
+    if not match_all:
+        return IngredientTerm.objects.filter(term__in=terms).values_list('recipe_id', flat=True).distinct()
+    if not terms:
+        return IngredientTerm.objects.none().values_list('recipe_id', flat=True)
+    # Walk the postings of the rarest term and probe the others, rather than
+    # grouping the postings of them all (common terms have thousands)
+    terms = sorted(terms, key=count_term_postings)
+    rows = IngredientTerm.objects.filter(term=terms[0])
+    for term in terms[1:]:
+        rows = rows.filter(Exists(IngredientTerm.objects.filter(term=term, recipe_id=OuterRef('recipe_id'))))
+    return rows.values_list('recipe_id', flat=True)
+
+def count_term_postings(term, limit=1000):
+    """Recipes indexed under term, counting no further than limit."""
+    return IngredientTerm.objects.filter(term=term)[:limit].count()
+
+def parse_ingredient_filter(ingredient_filter):
+    """('with', 'garlic-onion') is recipes with both, ('with-any', 'garlic-onion') with either."""
+    match, ingredients = ingredient_filter
+    return ingredients.split('-'), match == 'with'
+
+def encode_cursor(recipe):
+    """Position of recipe in the newest first listing, e.g. '1717171717000000-42'."""
+    published_at = recipe.first_published_at.astimezone(timezone.utc)
+    return f'{int(published_at.timestamp()) * 1000000 + published_at.microsecond}-{recipe.id}'
+
+def decode_cursor(cursor):
+    published_at, page_id = cursor.split('-')
+    seconds, microseconds = divmod(int(published_at), 1000000)
+    published_at = datetime.fromtimestamp(seconds, timezone.utc).replace(microsecond=microseconds)
+    return published_at, int(page_id)
+
+class HomePage(RoutablePageMixin, Page):
     introduction = RichTextField(blank=True)
+    recipes_per_page = 12
 
     content_panels = Page.content_panels + [
         FieldPanel('introduction'),
     ]
 
-    def get_context(self, request):
-        context = super().get_context(request)
-        context['recipes'] = RecipePage.objects.child_of(self).live().order_by('-first_published_at')
+    def get_recipes(self, cursor=None, ingredients=None, match_all=True):
+        """
+        One page of child recipes, newest first, starting after the cursor and
+        with all (or any) of the ingredients if given.
+        Returns (recipes, next cursor or None).
+        """
+        recipes = (RecipePage.objects.child_of(self).live()
+                   .order_by('-first_published_at', '-id')
+                   .prefetch_related(Prefetch(
+                       'image', queryset=Image.objects.prefetch_renditions(
+                           *get_all_responsive_filters('recipe-card')))))
+        if ingredients:
+            recipes = recipes.filter(id__in=get_recipe_ids_with_ingredients(ingredients, match_all))
+        if cursor is not None:
+            published_at, page_id = cursor
+            recipes = recipes.filter(Q(first_published_at__lt=published_at)
+                                     | Q(first_published_at=published_at, id__lt=page_id))
+        recipes = list(recipes[:self.recipes_per_page + 1])
+        if len(recipes) > self.recipes_per_page:
+            return recipes[:self.recipes_per_page], encode_cursor(recipes[self.recipes_per_page - 1])
+        return recipes, None
+
+    def get_context(self, request, *args, cursor=None, ingredient_filter=None, **kwargs):
+        context = super().get_context(request, *args, **kwargs)
+        ingredients, match_all = parse_ingredient_filter(ingredient_filter) if ingredient_filter else (None, True)
+        recipes, next_cursor = self.get_recipes(cursor, ingredients, match_all)
+        for recipe in recipes:
+            # Resolved here, so the cards don't render rich text or look up
+            # sites one by one
+            recipe.card_url = recipe.get_url(request)
+            recipe.card_introduction = Truncator(unescape(strip_tags(recipe.introduction))).words(20)
+        context['recipes'] = recipes
+        context['ingredients'] = ingredients
+        if ingredients:
+            context['ingredient_label'] = (' and ' if match_all else ' or ').join(ingredients)
+        context['next_cursor'] = next_cursor
+        if next_cursor:
+            if ingredient_filter:
+                subpage = self.reverse_subpage('filtered_older_recipes', args=[*ingredient_filter, next_cursor])
+            else:
+                subpage = self.reverse_subpage('older_recipes', args=[next_cursor])
+            context['next_url'] = self.get_url(request) + subpage
         return context
 
+    # Older recipes and ingredient filters by path rather than query string,
+    # CloudFront and the static export don't key pages by query string
+    @re_path(r'^after/(\d+-\d+)/$')
+    def older_recipes(self, request, cursor):
+        try:
+            cursor = decode_cursor(cursor)
+        except (OSError, OverflowError, ValueError):
+            raise Http404
+        return self.render(request, cursor=cursor)
+
+    # with/garlic-onion/ for recipes with both, with-any/garlic-onion/ for
+    # either, within what Wagtail's page URLs allow
+    @re_path(r'^(with|with-any)/(\w+(?:-\w+)*)/$')
+    def filtered_recipes(self, request, match, ingredients):
+        return self.render(request, ingredient_filter=(match, ingredients))
+
+    @re_path(r'^(with|with-any)/(\w+(?:-\w+)*)/after/(\d+-\d+)/$')
+    def filtered_older_recipes(self, request, match, ingredients, cursor):
+        try:
+            cursor = decode_cursor(cursor)
+        except (OSError, OverflowError, ValueError):
+            raise Http404
+        return self.render(request, cursor=cursor, ingredient_filter=(match, ingredients))
+
 class ShoppingListPage(Page):
+    # Recipes are looked up on demand through the catalog endpoint
+    # (cms.views.recipe_catalog), so the page stays the same size however
+    # many there are
     content_panels = Page.content_panels
 
-    def get_context(self, request):
-        context = super().get_context(request)
-        recipes = RecipePage.objects.live().order_by('title')
-        context['recipes'] = recipes
-        context['recipes_json'] = json.dumps([
-            {
-                'id': recipe.id,
-                'title': recipe.title,
-                'ingredients': recipe.ingredients,
-            }
-            for recipe in recipes
-        ])
-        return context
-
 class HeaderPage(Page):
     body = StreamField(HeaderBlock(), blank=True)
 
@@ -62,7 +226,9 @@ class HeaderPage(Page):
     ]
 
 
-from wagtail.signals import page_published
+from wagtail.signals import page_published, page_slug_changed, page_unpublished, post_page_move
+from mysite.snapshot_commit import on_snapshot_commit
+from . import static_export
 
 def invalidate_cloudfront_cache(paths):
     client = boto3.client('cloudfront')
@@ -81,19 +247,148 @@ def invalidate_cloudfront_cache(paths):
     )
     return response
 
-def get_related_pages():
-    related_pages = set()
-    
-    for page in HomePage.objects.live():
-        related_pages.add(page.url)
-    for page in ShoppingListPage.objects.live():
-        related_pages.add(page.url)
+def queue_invalidation(paths):
+    """Invalidate paths through the debouncing queue, or right away without one."""
+    if 'INVALIDATION_QUEUE_URL' in os.environ:
+        boto3.client('sqs').send_message(
+            QueueUrl=os.environ['INVALIDATION_QUEUE_URL'],
+            MessageBody=json.dumps({'paths': paths}))
+        print(f'Queued invalidation of {len(paths)} paths')
+    elif 'CLOUDFRONT_DISTRIBUTION_ID' in os.environ:
+        invalidate_cloudfront_cache(paths)
+
+def get_page_path(page):
+    url_parts = page.get_url_parts()
+    # None when the page isn't routable, e.g. outside of every site
+    return url_parts[2] if url_parts is not None else None
+
+def get_url_path_path(url_path):
+    """Path a page at url_path is served at, as get_page_path, None outside of every site."""
+    for site_root_path in Site.get_site_root_paths():
+        if url_path.startswith(site_root_path.root_path):
+            return reverse('wagtail_serve', args=(url_path[len(site_root_path.root_path):],))
+    return None
+
+def is_in_header_menu(page):
+    return page.show_in_menus and page.depth > 2 and page.get_parent().is_site_root()
+
+def get_dependent_pages(page):
+    """
+    Live pages whose HTML changes when page is published or unpublished: the
+    page itself, the listings rendering it and, when it is in the header
+    menu, every page.
+    """
+    page = page.specific
+    if is_in_header_menu(page):
+        return list(Page.objects.live().filter(depth__gt=1).specific())
+    pages = [page] if page.live else []
+    if hasattr(page, 'get_listing_pages'):
+        pages += page.get_listing_pages()
+    return pages
+
+def refresh_pages(pages, paths=()):
+    """Re-export (or just invalidate) pages and invalidate paths along with them."""
+    if static_export.is_enabled():
+        paths = list(paths) + static_export.export_pages(pages)
+    else:
+        paths = list(paths) + [path for path in map(get_page_path, pages) if path is not None]
+    for listing in pages:
+        path = get_page_path(listing)
+        if isinstance(listing, HomePage) and path is not None:
+            # Every older and filtered page of the listing shifts too
+            paths += [f'{path}after/*', f'{path}with/*', f'{path}with-any/*']
+    if paths:
+        queue_invalidation(sorted(set(paths)))
+
+def refresh_pages_later(pages, paths=()):
+    """
+    refresh_pages on the write queue, for more pages than a request should
+    render. Right away without a queue, or when nothing is exported.
+    """
+    if not (static_export.is_enabled() and 'WRITE_QUEUE_URL' in os.environ):
+        refresh_pages(pages, paths)
+        return
+    boto3.client('sqs').send_message(
+        QueueUrl=os.environ['WRITE_QUEUE_URL'],
+        MessageBody=json.dumps({'command': 'refresh_pages', 'pageIds': [page.id for page in pages],
+                                'paths': list(paths)}))
+    print(f'Queued refresh of {len(pages)} pages')
+
+def run_page_refresh(page_ids, paths):
+    """The job refresh_pages_later queues, see mysite.wsgi.run_queued_event."""
+    refresh_pages(list(Page.objects.live().filter(id__in=page_ids).specific()), paths)
+
+def refresh_dependent_pages(page):
+    page = page.specific
+    paths = []
+    if not page.live:
+        # Unpublished, leave the path to Lambda (a 404 or a redirect)
+        path = get_page_path(page)
+        if path is not None:
+            if static_export.is_enabled():
+                static_export.delete_path(path)
+            paths.append(path)
+    if isinstance(page, RecipePage):
+        # Merged shopping lists including it, catalog pages listing it and
+        # searches finding it, see cms.views
+        paths += [f"{reverse('cms:index')}shopping-list/*", f"{reverse('cms:index')}recipes/*",
+                  f"{reverse('cms:index')}search/*"]
+    if is_in_header_menu(page):
+        # Every page renders the menu
+        refresh_pages_later(get_dependent_pages(page), paths)
+    else:
+        refresh_pages(get_dependent_pages(page), paths)
+
+def refresh_moved_pages(page, url_path_before, parent_before=None):
+    """
+    page and its descendants moved from url_path_before: stop serving them
+    there, export them where they are now and refresh the listings they
+    left and joined.
+    """
+    page = page.specific
+    if page.is_site_root():
+        # Paths are relative to it, none of them changed
+        return
+    paths = []
+    path_before = get_url_path_path(url_path_before)
+    if path_before is not None:
+        if static_export.is_enabled():
+            static_export.delete_prefix(path_before)
+        paths.append(f'{path_before}*')
+    pages = list(Page.objects.live().descendant_of(page, inclusive=True).specific())
+    if hasattr(page, 'get_listing_pages'):
+        pages += page.get_listing_pages()
+    if parent_before is not None and parent_before.live:
+        pages.append(parent_before.specific)
+    refresh_pages_later(pages, paths)
+
+def update_ingredients_on_publish(sender, instance, **kwargs):
+    update_ingredient_rows(instance)
+
+def remove_ingredient_terms_on_unpublish(sender, instance, **kwargs):
+    update_ingredient_terms(instance, set())
+
+def invalidate_cache_on_publish(sender, instance, **kwargs):
+    # Once the snapshot version with the publish is committed, so rendered
+    # pages see it and nothing is exported for writes that don't land
+    on_snapshot_commit(lambda: refresh_dependent_pages(instance))
 
-    return list(related_pages)
+def invalidate_cache_on_slug_change(sender, instance, instance_before, **kwargs):
+    on_snapshot_commit(lambda: refresh_moved_pages(instance, instance_before.url_path))
 
-def invalidate_cache_on_publish(sender, **kwargs):
-    paths = get_related_pages()
-    invalidate_cloudfront_cache(paths)
+def invalidate_cache_on_move(sender, instance, url_path_before, url_path_after, parent_page_before, **kwargs):
+    if url_path_before != url_path_after:
+        on_snapshot_commit(lambda: refresh_moved_pages(instance, url_path_before, parent_page_before))
 
-# Register listeners to invalidate cache for Home Page when Recipe Page is updated.
-page_published.connect(invalidate_cache_on_publish, sender=RecipePage)
+# Keep the parsed ingredients and the term index in step with published recipes,
+# before the pages showing them are refreshed.
+page_published.connect(update_ingredients_on_publish, sender=RecipePage)
+page_unpublished.connect(remove_ingredient_terms_on_unpublish, sender=RecipePage)
+# Register listeners to re-export and invalidate the pages depending on a page
+# when it is (un)published.
+page_published.connect(invalidate_cache_on_publish)
+page_unpublished.connect(invalidate_cache_on_publish)
+# Pages served at a new path (a move sends no publish signal) are dropped at
+# the old one.
+page_slug_changed.connect(invalidate_cache_on_slug_change)
+post_page_move.connect(invalidate_cache_on_move)
@@ -0,0 +1,167 @@
+"""
+Renditions generated as soon as an image is saved.
+
+Every filter spec the public templates ask for is registered here, with
+register_rendition_filter next to the code rendering it. Saving an image
+queues a job on the write queue (see mysite.wsgi.batch_handler) generating
+them all, so public requests find the renditions in place instead of
+decoding the original, uploading the result and writing the snapshot.
+Without WRITE_QUEUE_URL they are generated in the saving request.
+The job is queued once the snapshot version with the image is committed,
+and fails (to be redelivered) if the snapshot it runs on lacks the image.
+
+Rendering never generates them: anonymous reads run on a read only snapshot
+(see mysite.wsgi.render_read_only_request). Templates use the renditions
+that exist (find_renditions) and queue a job for an image missing any, e.g.
+one uploaded before its filter was registered. Migration 0012 and the
+backfill_renditions command queue jobs for every image.
+
+Responsive images (RESPONSIVE_IMAGES, rendered by the responsive_image
+template tag) register one rendition per width and format.
+"""
+import json
+import os
+
+import boto3
+from django.db import transaction
+from mysite.snapshot_commit import on_snapshot_commit
+from wagtail.images import get_image_model
+from wagtail.images.models import Filter, SourceImageIOError
+from wagtail.images.shortcuts import get_renditions_or_not_found
+
+RENDITION_FILTERS = []
+
+# Images per backfill job
+BACKFILL_CHUNK_SIZE = 20
+
+# Images this container queued missing renditions of, so rendering them
+# again before the job's version lands doesn't queue them again
+requested_image_ids = set()
+
+# Modern formats offered as <source>s before the original format fallback
+RESPONSIVE_FORMATS = ['avif', 'webp']
+
+# Image slots rendered at several widths: the aspect ratio they're cropped
+# to, the widths to offer and the sizes attribute telling browsers how wide
+# the slot is laid out.
+RESPONSIVE_IMAGES = {
+    # Home page cards, three to a row
+    'recipe-card': {
+        'ratio': (4, 3),
+        'widths': [400, 800],
+        'sizes': '(max-width: 600px) 100vw, 30vw',
+    },
+    # Recipe page hero, full width
+    'recipe-hero': {
+        'ratio': (16, 5),
+        'widths': [480, 800, 1600],
+        'sizes': '100vw',
+    },
+}
+
+
+def register_rendition_filter(*filter_specs):
+    for filter_spec in filter_specs:
+        if filter_spec not in RENDITION_FILTERS:
+            RENDITION_FILTERS.append(filter_spec)
+
+
+def get_responsive_filters(name, image_format=None) -> list:
+    """Filter specs of a responsive image slot, by width, in one format."""
+    policy = RESPONSIVE_IMAGES[name]
+    ratio_width, ratio_height = policy['ratio']
+    filter_specs = [f'fill-{width}x{width * ratio_height // ratio_width}' for width in policy['widths']]
+    if image_format is not None:
+        filter_specs = [f'{filter_spec}|format-{image_format}' for filter_spec in filter_specs]
+    return filter_specs
+
+
+def get_all_responsive_filters(name) -> list:
+    """Filter specs of a responsive image slot in the original and modern formats."""
+    filter_specs = get_responsive_filters(name)
+    for image_format in RESPONSIVE_FORMATS:
+        filter_specs += get_responsive_filters(name, image_format)
+    return filter_specs
+
+
+for responsive_image in RESPONSIVE_IMAGES:
+    register_rendition_filter(*get_all_responsive_filters(responsive_image))
+
+
+def generate_renditions(image_ids):
+    """
+    Generate the registered renditions that are missing for these images.
+    Raises if any of them isn't in the snapshot, so the job is retried.
+    """
+    Image = get_image_model()
+    images = Image.objects.filter(id__in=image_ids).prefetch_renditions(*RENDITION_FILTERS)
+    for image in images:
+        try:
+            image.get_renditions(*RENDITION_FILTERS)
+        except SourceImageIOError as e:
+            # Retrying won't bring the file back
+            print(f'Original of image {image.id} is missing: {e}')
+            continue
+        print(f'Generated renditions of image {image.id}')
+    missing = set(image_ids) - {image.id for image in images}
+    if missing:
+        raise Image.DoesNotExist(f'Images {sorted(missing)} not found')
+
+
+def queue_renditions(image_ids):
+    boto3.client('sqs').send_message(
+        QueueUrl=os.environ['WRITE_QUEUE_URL'],
+        MessageBody=json.dumps({'command': 'renditions', 'imageIds': image_ids}))
+    print(f'Queued renditions of images {image_ids}')
+
+
+def request_renditions(image_id):
+    """Have the renditions an image was rendered without generated."""
+    if image_id in requested_image_ids:
+        return
+    requested_image_ids.add(image_id)
+    try:
+        queue_renditions([image_id])
+    except Exception as e:
+        # The page renders without them either way
+        requested_image_ids.discard(image_id)
+        print(f'Could not queue renditions of image {image_id}: {e}')
+
+
+def find_renditions(image, filter_specs) -> dict:
+    """
+    The existing renditions of image by filter spec, from the prefetched ones
+    if any. Missing ones are left out and requested.
+
+    Without WRITE_QUEUE_URL the database is writable and they're generated.
+    """
+    if 'WRITE_QUEUE_URL' not in os.environ:
+        # A broken image rather than an error if the original is missing
+        return get_renditions_or_not_found(image, filter_specs)
+    found = image.find_existing_renditions(*map(Filter, filter_specs))
+    renditions = {filter.spec: rendition for filter, rendition in found.items()}
+    if len(renditions) < len(filter_specs):
+        request_renditions(image.id)
+    return renditions
+
+
+def backfill_renditions(image_ids):
+    """Generate the registered renditions of existing images."""
+    image_ids = list(image_ids)
+    for start in range(0, len(image_ids), BACKFILL_CHUNK_SIZE):
+        chunk = image_ids[start:start + BACKFILL_CHUNK_SIZE]
+        if 'WRITE_QUEUE_URL' in os.environ:
+            # Once the snapshot being written is committed, as on save
+            on_snapshot_commit(lambda chunk=chunk: queue_renditions(chunk))
+        else:
+            generate_renditions(chunk)
+
+
+def generate_renditions_on_save(sender, instance, **kwargs):
+    image_id = instance.id
+    if 'WRITE_QUEUE_URL' in os.environ:
+        # Once the snapshot with the image is committed, so the job finds it
+        on_snapshot_commit(lambda: queue_renditions([image_id]))
+    else:
+        # In this request, so the renditions are saved with the image
+        transaction.on_commit(lambda: generate_renditions([image_id]))
@@ -0,0 +1,88 @@
+"""
+Full text search of live recipes on SQLite FTS5.
+
+cms_recipesearch (see migration 0011) holds the plain text of every live
+recipe's title, introduction, ingredients and instructions under the
+recipe's id. RecipePage.save updates it in the same transaction as the page
+row, so a publish or unpublish is searchable in exactly the snapshot version
+that has it and the index never needs a rebuild. A trigger drops deleted
+recipes.
+
+Results are ranked by BM25 weighted towards the title. Every word must
+match, the last one (and any ending in '*') as a prefix, so searches work
+as you type. Matches are highlighted in the title and in an excerpt of the
+best matching column.
+"""
+import re
+
+from bs4 import BeautifulSoup
+from django.db import connection
+from django.utils.html import escape
+
+SEARCH_TABLE = 'cms_recipesearch'
+SEARCH_COLUMNS = ['title', 'introduction', 'ingredients', 'instructions']
+# BM25 weight of each column, a title match counts most
+SEARCH_WEIGHTS = [10.0, 4.0, 2.0, 1.0]
+# Tokens of the excerpt around the best match
+SNIPPET_TOKENS = 16
+
+# Around matches in FTS5 output, replaced by <mark> once the text is escaped
+MATCH_START, MATCH_END = '\x02', '\x03'
+QUERY_WORD = re.compile(r'(\w+)(\*?)')
+
+
+def get_text(html) -> str:
+    """Plain text of rich text, blocks and list items separated by spaces."""
+    return ' '.join(BeautifulSoup(html or '', 'html.parser').get_text(' ').split())
+
+
+def index_recipe(recipe):
+    """Index the live content of recipe, or drop it if it isn't live."""
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE rowid = %s', [recipe.id])
+        if recipe.live:
+            cursor.execute(
+                f"INSERT INTO {SEARCH_TABLE} (rowid, {', '.join(SEARCH_COLUMNS)}) VALUES (%s, %s, %s, %s, %s)",
+                [recipe.id, recipe.title, get_text(recipe.introduction),
+                 get_text(recipe.ingredients), get_text(recipe.instructions)])
+
+
+def build_query(text):
+    """FTS5 query of a search, None if it has no words."""
+    words = QUERY_WORD.findall(text)
+    if not words:
+        return None
+    # Still being typed unless followed by a space
+    as_you_type = not text[-1:].isspace()
+    return ' '.join(
+        # Quoted, so words like AND or NEAR aren't operators
+        f'"{word}"*' if prefix or (as_you_type and position == len(words) - 1) else f'"{word}"'
+        for position, (word, prefix) in enumerate(words)
+    )
+
+
+def render_highlight(text) -> str:
+    return escape(text).replace(MATCH_START, '<mark>').replace(MATCH_END, '</mark>')
+
+
+def search_recipes(text, limit, offset=0) -> list:
+    """
+    Best matches of a search as [{'id', 'title', 'excerpt', 'score'}], title
+    and excerpt HTML with matches in <mark>s.
+    """
+    query = build_query(text)
+    if query is None:
+        return []
+    weights = ', '.join(map(str, SEARCH_WEIGHTS))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'SELECT rowid, highlight({SEARCH_TABLE}, 0, %s, %s),'
+            f' snippet({SEARCH_TABLE}, -1, %s, %s, %s, %s), bm25({SEARCH_TABLE}, {weights}) AS score'
+            f' FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s ORDER BY score, rowid LIMIT %s OFFSET %s',
+            [MATCH_START, MATCH_END, MATCH_START, MATCH_END, '…', SNIPPET_TOKENS, query, limit, offset])
+        rows = cursor.fetchall()
+    return [
+        # bm25 is lower for better matches
+        {'id': recipe_id, 'title': render_highlight(title), 'excerpt': render_highlight(excerpt), 'score': -score}
+        for recipe_id, title, excerpt, score in rows
+    ]
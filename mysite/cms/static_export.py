@@ -0,0 +1,95 @@
+"""
+Static export of public pages to the bucket, served by CloudFront.
+
+Pages only change when something is published, so on publish the affected
+pages are rendered as an anonymous visitor would see them and uploaded as
+HTML under STATIC_EXPORT_PREFIX, keyed by their path ('/recipes/soup/' is
+stored at 'static-pages/recipes/soup/'). CloudFront serves the default
+behavior from there and only falls back to Lambda when an object is missing,
+so pages that can't be exported (private, redirects, errors) are simply
+rendered by Django as before.
+
+Exports run once the snapshot version with the publish is committed (see
+mysite.snapshot_commit). Pages moved or renamed are deleted under their old
+path, and large refreshes (a header menu page, a moved subtree) are queued
+for the batch handler rather than rendered in the request.
+"""
+from functools import lru_cache
+from urllib.parse import urlsplit
+
+import boto3
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.test import RequestFactory
+from wagtail.views import serve
+
+
+@lru_cache(maxsize=None)
+def get_s3_client():
+    return boto3.session.Session().client('s3')
+
+
+def is_enabled() -> bool:
+    return bool(settings.STATIC_EXPORT_PREFIX and settings.STATIC_EXPORT_BUCKET_NAME)
+
+
+def get_object_key(path) -> str:
+    return f"{settings.STATIC_EXPORT_PREFIX.strip('/')}{path}"
+
+
+def render_page(page):
+    """Returns (path, html) of a live page, html is None if it isn't public."""
+    url_parts = page.get_url_parts()
+    if url_parts is None:
+        # Not routable, e.g. outside of every site
+        return None, None
+    _, root_url, path = url_parts
+    root = urlsplit(root_url)
+    request = RequestFactory().get(path, HTTP_HOST=root.netloc, secure=root.scheme == 'https')
+    request.user = AnonymousUser()
+    # Through the serve view, so privacy restrictions and before_serve_page
+    # hooks apply as they would to a visitor
+    response = serve(request, path.lstrip('/'))
+    if hasattr(response, 'render'):
+        response.render()
+    if response.status_code != 200 or response.has_header('Set-Cookie'):
+        return path, None
+    return path, response.content
+
+
+def export_pages(pages) -> list:
+    """Upload the public pages among pages, delete the others. Returns their paths."""
+    paths = []
+    for page in pages:
+        path, html = render_page(page)
+        if path is None:
+            continue
+        if html is None:
+            delete_path(path)
+        else:
+            get_s3_client().put_object(
+                Bucket=settings.STATIC_EXPORT_BUCKET_NAME,
+                Key=get_object_key(path),
+                Body=html,
+                ContentType='text/html; charset=utf-8')
+            print(f'Exported {path}')
+        paths.append(path)
+    return paths
+
+
+def delete_path(path):
+    """Stop serving path statically, CloudFront falls back to Lambda for it."""
+    get_s3_client().delete_object(
+        Bucket=settings.STATIC_EXPORT_BUCKET_NAME, Key=get_object_key(path))
+    print(f'Removed export of {path}')
+
+
+def delete_prefix(path):
+    """Stop serving path and every path below it statically, e.g. after a move."""
+    bucket, prefix = settings.STATIC_EXPORT_BUCKET_NAME, get_object_key(path)
+    paginator = get_s3_client().get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        keys = [{'Key': item['Key']} for item in page.get('Contents', [])]
+        if keys:
+            get_s3_client().delete_objects(Bucket=bucket, Delete={'Objects': keys, 'Quiet': True})
+    print(f'Removed exports under {path}')
@@ -0,0 +1,64 @@
+from django import template
+
+from cms.renditions import (RESPONSIVE_FORMATS, RESPONSIVE_IMAGES, find_renditions, get_responsive_filters,
+                            get_all_responsive_filters)
+
+
+register = template.Library()
+
+
+def get_srcset(renditions) -> str:
+    # fill doesn't upscale, small originals end up with several renditions
+    # of the same width and a srcset may list each width once
+    by_width = {}
+    for rendition in renditions:
+        by_width.setdefault(rendition.width, rendition)
+    return ', '.join(f'{rendition.url} {width}w' for width, rendition in by_width.items())
+
+
+def get_original(image) -> dict:
+    """Stands in for a rendition that doesn't exist yet."""
+    return {'url': image.file.url, 'width': image.width, 'height': image.height}
+
+
+@register.simple_tag
+def existing_rendition(image, filter_spec):
+    """
+    Like {% image image filter_spec as ... %} but never generating it, the
+    original until the rendition exists (see cms.renditions.find_renditions).
+    """
+    return find_renditions(image, [filter_spec]).get(filter_spec) or get_original(image)
+
+
+@register.inclusion_tag('cms/includes/responsive_image.html')
+def responsive_image(image, name, alt='', css_class='', loading='lazy'):
+    """
+    A <picture> of image in the RESPONSIVE_IMAGES slot name: AVIF and WebP
+    sources at every width, falling back to the original format.
+
+    Only renditions that exist are offered, a format none exist in yet is
+    left out and the original image stands in for the fallback.
+    """
+    if not image:
+        return {'image': None}
+    # One query for all of them, none if prefetched (see HomePage.get_recipes)
+    renditions = find_renditions(image, get_all_responsive_filters(name))
+
+    def existing(filter_specs):
+        return [renditions[filter_spec] for filter_spec in filter_specs if filter_spec in renditions]
+
+    fallback = existing(get_responsive_filters(name))
+    sources = [{
+        'type': f'image/{image_format}',
+        'srcset': get_srcset(existing(get_responsive_filters(name, image_format))),
+    } for image_format in RESPONSIVE_FORMATS]
+    return {
+        'image': image,
+        'sources': [source for source in sources if source['srcset']],
+        'fallback': fallback[0] if fallback else get_original(image),
+        'srcset': get_srcset(fallback),
+        'sizes': RESPONSIVE_IMAGES[name]['sizes'],
+        'alt': alt,
+        'css_class': css_class,
+        'loading': loading,
+    }
@@ -1,3 +1,63 @@
-from django.test import TestCase
+from decimal import Decimal
 
-# Create your tests here.
+from django.test import SimpleTestCase, TestCase
+from django.urls import reverse
+from wagtail.models import Page
+
+from cms.ingredients import parse_line
+from cms.models import RecipeIngredient, RecipePage
+
+
+class ParseLineTests(SimpleTestCase):
+
+    def test_quantity_and_unit(self):
+        self.assertEqual(parse_line('1 1/2 cups milk'),
+                         {'name': 'milk', 'quantity': Decimal('1.500'), 'unit': 'cup'})
+        self.assertEqual(parse_line('1,5 kg potatoes'),
+                         {'name': 'potatoes', 'quantity': Decimal('1500.000'), 'unit': 'g'})
+
+    def test_grouped_digits(self):
+        self.assertEqual(parse_line('1,000g flour'),
+                         {'name': 'flour', 'quantity': Decimal('1000.000'), 'unit': 'g'})
+        self.assertEqual(parse_line('1,000.5 ml water'),
+                         {'name': 'water', 'quantity': Decimal('1000.500'), 'unit': 'ml'})
+
+    def test_quantity_too_large(self):
+        self.assertEqual(parse_line('12345678901 kg sugar'), {'name': 'sugar', 'quantity': None, 'unit': ''})
+        self.assertEqual(parse_line('1' * 40 + ' g salt'), {'name': 'salt', 'quantity': None, 'unit': ''})
+        self.assertEqual(parse_line('999999 kg salt')['quantity'], Decimal('999999000.000'))
+
+    def test_descriptions_left_out_of_name(self):
+        self.assertEqual(parse_line('2 cloves garlic, minced')['name'], 'garlic')
+        self.assertEqual(parse_line('garlic, minced')['name'], parse_line('Garlic')['name'])
+        self.assertEqual(parse_line('3 leeks (sliced)')['name'], 'leeks')
+        self.assertEqual(parse_line('(optional) chilli')['name'], 'chilli')
+        # Nothing but a description, it names the ingredient
+        self.assertEqual(parse_line(', minced')['name'], 'minced')
+
+
+class IngredientRowsTests(TestCase):
+
+    def test_publish_with_quantity_too_large(self):
+        home = Page.objects.get(depth=1)
+        recipe = RecipePage(title='Sweet', slug='sweet',
+                            ingredients='<ul><li>12345678901 kg sugar</li><li>1,000g flour</li></ul>')
+        home.add_child(instance=recipe)
+        recipe.save_revision().publish()
+        rows = RecipeIngredient.objects.filter(recipe=recipe)
+        self.assertEqual([(row.name, row.quantity, row.unit) for row in rows],
+                         [('sugar', None, ''), ('flour', Decimal('1000.000'), 'g')])
+
+
+class CatalogETagTests(TestCase):
+
+    def test_etag_only_on_success(self):
+        for name, bad_query in [('cms:recipe_catalog', {'limit': '0'}), ('cms:recipe_search', {'offset': '-1'})]:
+            response = self.client.get(reverse(name), {'q': 'pie'})
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.has_header('ETag'))
+            self.assertEqual(self.client.get(reverse(name), {'q': 'pie'},
+                                             HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+            response = self.client.get(reverse(name), bad_query)
+            self.assertEqual(response.status_code, 400)
+            self.assertFalse(response.has_header('ETag'))
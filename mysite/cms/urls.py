@@ -1,7 +1,13 @@
-from django.urls import path
+from django.urls import path, re_path
 from . import views
 app_name = 'cms'
 
 urlpatterns = [
     # Home page.
-    path('', views.index, name='index'), ]
+    path('', views.index, name='index'),
+    # Merged ingredients of recipes, ids in the path as CloudFront's cache
+    # policy ignores query strings
+    re_path(r'^shopping-list/(?P<recipe_ids>\d+(?:,\d+)*)/$', views.shopping_list, name='shopping_list'),
+    path('recipes/', views.recipe_catalog, name='recipe_catalog'),
+    path('search/', views.recipe_search, name='recipe_search'),
+]
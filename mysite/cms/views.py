@@ -1,6 +1,18 @@
+import hashlib
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import Counter
+from functools import wraps
+
+from django.db.models import Count, Max, Q, Sum
+from django.http import Http404, JsonResponse
 from django.shortcuts import render
+from django.views.decorators.http import condition, require_safe
+from mysite.page_cache import get_current_version_key
 from wagtail.models import Page
-from .models import RecipePage
+from wagtail.rich_text import expand_db_html
+from .models import RecipeIngredient, RecipePage, get_recipe_ids_with_ingredients
+from .search import search_recipes
 
 # Create your views here.
 # from .models import Topic
@@ -18,3 +30,168 @@ def index(request):
     response['Pragma'] = 'no-cache'
     response['Expires'] = '0'
     return response
+
+
+# Longest list of recipes merged in one request
+MAX_SHOPPING_LIST_RECIPES = 100
+# Largest id SQLite can bind, anything above can't be a recipe
+MAX_ID = 2 ** 63 - 1
+
+
+@require_safe
+def shopping_list(request, recipe_ids):
+    """
+    The merged ingredients of live recipes, e.g. /myapp/shopping-list/3,7,7/
+    for recipe 3 once and recipe 7 twice. Lines with the same name and unit
+    are summed, lines without a quantity counted.
+    """
+    recipe_ids = [int(recipe_id) for recipe_id in recipe_ids.split(',')]
+    if any(recipe_id > MAX_ID for recipe_id in recipe_ids):
+        raise Http404('No such recipe')
+    if len(recipe_ids) > MAX_SHOPPING_LIST_RECIPES:
+        return JsonResponse({'error': 'Too many recipes'}, status=400)
+    servings = Counter(recipe_ids)
+    rows = (RecipeIngredient.objects
+            .filter(recipe_id__in=servings, recipe__live=True)
+            .values('recipe_id', 'name', 'unit')
+            .annotate(quantity=Sum('quantity'), lines=Count('id'))
+            .order_by())
+    items = {}
+    for row in rows:
+        item = items.setdefault((row['name'], row['unit']), {
+            'name': row['name'], 'unit': row['unit'], 'quantity': None, 'count': 0})
+        times = servings[row['recipe_id']]
+        if row['quantity'] is not None:
+            item['quantity'] = (item['quantity'] or 0) + row['quantity'] * times
+        item['count'] += row['lines'] * times
+    return JsonResponse({
+        'items': [
+            dict(item, quantity=float(item['quantity']) if item['quantity'] is not None else None)
+            for _, item in sorted(items.items())
+        ]
+    })
+
+
+# Fields a catalog request can select, by name
+CATALOG_FIELDS = {
+    'id': lambda recipe, request: recipe.id,
+    'title': lambda recipe, request: recipe.title,
+    'url': lambda recipe, request: recipe.get_url(request),
+    'introduction': lambda recipe, request: expand_db_html(recipe.introduction),
+    'ingredients': lambda recipe, request: [
+        {'name': row.name, 'quantity': float(row.quantity) if row.quantity is not None else None,
+         'unit': row.unit}
+        for row in recipe.ingredient_rows.all()],
+}
+CATALOG_DEFAULT_FIELDS = ['id', 'title']
+CATALOG_PAGE_SIZE = 50
+CATALOG_MAX_PAGE_SIZE = 100
+
+
+def encode_catalog_cursor(recipe) -> str:
+    return urlsafe_b64encode(json.dumps([recipe.title, recipe.id]).encode()).decode()
+
+
+def decode_catalog_cursor(cursor):
+    title, recipe_id = json.loads(urlsafe_b64decode(cursor.encode()))
+    return str(title), int(recipe_id)
+
+
+def get_catalog_etag(request):
+    """Strong ETag of a catalog response, free when the snapshot version is known."""
+    version_key = get_current_version_key()
+    if version_key is None:
+        # Writes and runserver, fall back to what the catalog shows
+        state = RecipePage.objects.live().aggregate(
+            count=Count('id'), latest=Max('last_published_at'), last_id=Max('id'))
+        version_key = f"{state['count']}/{state['latest']}/{state['last_id']}"
+    return hashlib.sha1(f'{version_key}/{request.get_full_path()}'.encode()).hexdigest()
+
+
+def etag_on_success(view):
+    """
+    condition(etag_func=get_catalog_etag), but with no ETag on errors: a
+    400 isn't what the ETag of its URL describes.
+    """
+    conditional_view = condition(etag_func=get_catalog_etag)(view)
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        response = conditional_view(request, *args, **kwargs)
+        if response.status_code not in (200, 304):
+            response.headers.pop('ETag', None)
+        return response
+    return wrapper
+
+
+@require_safe
+@etag_on_success
+def recipe_catalog(request):
+    """
+    Live recipes ordered by title, a page at a time: ?q= title prefix,
+    ?ingredients=garlic,onion with all of them (or any, with ?match=any),
+    ?fields=id,title,url,introduction,ingredients, ?limit= and ?after= the
+    next cursor of the previous page.
+    """
+    fields = request.GET.get('fields', '').split(',') if request.GET.get('fields') else CATALOG_DEFAULT_FIELDS
+    unknown = [field for field in fields if field not in CATALOG_FIELDS]
+    if unknown:
+        return JsonResponse({'error': f'Unknown fields: {", ".join(unknown)}'}, status=400)
+    try:
+        limit = min(int(request.GET.get('limit', CATALOG_PAGE_SIZE)), CATALOG_MAX_PAGE_SIZE)
+        cursor = decode_catalog_cursor(request.GET['after']) if 'after' in request.GET else None
+    except (TypeError, ValueError):
+        return JsonResponse({'error': 'Invalid limit or cursor'}, status=400)
+    if limit < 1:
+        return JsonResponse({'error': 'Invalid limit or cursor'}, status=400)
+
+    recipes = RecipePage.objects.live().order_by('title', 'id')
+    if request.GET.get('q'):
+        recipes = recipes.filter(title__istartswith=request.GET['q'])
+    if request.GET.get('ingredients'):
+        recipes = recipes.filter(id__in=get_recipe_ids_with_ingredients(
+            request.GET['ingredients'].split(','), match_all=request.GET.get('match') != 'any'))
+    if cursor is not None:
+        title, recipe_id = cursor
+        recipes = recipes.filter(Q(title__gt=title) | Q(title=title, id__gt=recipe_id))
+    if 'ingredients' in fields:
+        recipes = recipes.prefetch_related('ingredient_rows')
+    recipes = list(recipes[:limit + 1])
+
+    next_cursor = encode_catalog_cursor(recipes[limit - 1]) if len(recipes) > limit else None
+    return JsonResponse({
+        'results': [{field: CATALOG_FIELDS[field](recipe, request) for field in fields}
+                    for recipe in recipes[:limit]],
+        'next': next_cursor,
+    })
+
+
+# Deepest a search can be paged, rank order has no cursor to seek to
+SEARCH_MAX_OFFSET = 1000
+
+
+@require_safe
+@etag_on_success
+def recipe_search(request):
+    """
+    Live recipes matching ?q= in their title, introduction, ingredients or
+    instructions, best first (see cms.search), ?limit= at a time from
+    ?offset=, the next offset of the previous page.
+    """
+    try:
+        limit = min(int(request.GET.get('limit', CATALOG_PAGE_SIZE)), CATALOG_MAX_PAGE_SIZE)
+        offset = int(request.GET.get('offset', 0))
+    except ValueError:
+        return JsonResponse({'error': 'Invalid limit or offset'}, status=400)
+    if limit < 1 or not 0 <= offset <= SEARCH_MAX_OFFSET:
+        return JsonResponse({'error': 'Invalid limit or offset'}, status=400)
+
+    results = search_recipes(request.GET.get('q', ''), limit + 1, offset)
+    recipes = RecipePage.objects.live().in_bulk([result['id'] for result in results[:limit]])
+    return JsonResponse({
+        'results': [
+            dict(result, url=recipes[result['id']].get_url(request))
+            for result in results[:limit] if result['id'] in recipes
+        ],
+        'next': offset + limit if len(results) > limit and offset + limit <= SEARCH_MAX_OFFSET else None,
+    })
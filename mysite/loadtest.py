@@ -0,0 +1,328 @@
+"""
+Local load test for the snapshot/version sync protocol.
+
+Runs N simulated Lambda containers, one process each with its own local
+snapshot, against local S3 and DynamoDB stand-ins (an in-process moto server
+unless --endpoint-url is given) and replays a mix of anonymous GETs and admin
+logins. Every login is a POST that commits a new session row, so once the
+run is over each acknowledged login must still be in the latest snapshot,
+anything missing is a lost update.
+
+    python loadtest.py --containers 8 --requests 400 --post-ratio 0.25
+
+Reports throughput, p50/p99 latency per method, the conflict rate, retries
+per write and lost updates.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import secrets
+import socket
+import sqlite3
+import sys
+import tempfile
+import time
+import uuid
+
+import boto3
+
+MYSITE_DIR = os.path.dirname(os.path.abspath(__file__))
+HOST = '1234567890.execute-api.us-east-1.amazonaws.com'
+
+
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def set_up_stand_ins(args):
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=os.environ['BUCKET_NAME'])
+    s3.put_bucket_versioning(Bucket=os.environ['BUCKET_NAME'],
+                             VersioningConfiguration={'Status': 'Enabled'})
+    dynamodb = boto3.client('dynamodb')
+    dynamodb.create_table(
+        TableName=os.environ['TABLE_NAME'],
+        KeySchema=[{'AttributeName': 'domainName', 'KeyType': 'HASH'},
+                   {'AttributeName': 'version', 'KeyType': 'RANGE'}],
+        AttributeDefinitions=[{'AttributeName': 'domainName', 'AttributeType': 'S'},
+                              {'AttributeName': 'version', 'AttributeType': 'N'}],
+        BillingMode='PAY_PER_REQUEST')
+    if os.environ.get('DYNAMODB_SESSIONS_TABLE_NAME'):
+        dynamodb.create_table(
+            TableName=os.environ['DYNAMODB_SESSIONS_TABLE_NAME'],
+            KeySchema=[{'AttributeName': 'session_key', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'session_key', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST')
+    sm = boto3.client('secretsmanager')
+    for name, value in [('SUPER_USEREMAIL', 'admin@example.com'),
+                        ('SUPER_USERNAME', args.username),
+                        ('SUPER_USERPASSWORD', args.password)]:
+        try:
+            sm.create_secret(Name=name, SecretString=value)
+        except sm.exceptions.ResourceExistsException:
+            sm.put_secret_value(SecretId=name, SecretString=value)
+
+
+def make_event(method, path, headers=None, body=None) -> dict:
+    headers = {'Host': HOST, 'X-Forwarded-Proto': 'https', 'X-Forwarded-Port': '443',
+               **(headers or {})}
+    return {
+        'resource': '/{proxy+}',
+        'path': path,
+        'httpMethod': method,
+        'headers': headers,
+        'multiValueHeaders': {key: [value] for key, value in headers.items()},
+        'queryStringParameters': None,
+        'multiValueQueryStringParameters': None,
+        'requestContext': {'path': path, 'httpMethod': method},
+        'body': body,
+        'isBase64Encoded': False,
+    }
+
+
+def make_login_event(username, password) -> dict:
+    # An unmasked token is accepted as long as it matches the cookie
+    token = secrets.token_hex(16)
+    return make_event('POST', '/cms/login/', {
+        'Cookie': f'csrftoken={token}',
+        'Content-Type': 'application/x-www-form-urlencoded',
+        'Referer': f'https://{HOST}/cms/login/',
+    }, f'csrfmiddlewaretoken={token}&username={username}&password={password}')
+
+
+def get_session_key(response) -> str:
+    for cookie in (response.get('multiValueHeaders') or {}).get('Set-Cookie', []):
+        name, _, value = cookie.split(';')[0].partition('=')
+        if name.strip() == 'sessionid':
+            return value
+    return None
+
+
+def run_container(index, env, tasks, results, verbose):
+    """One simulated Lambda container, handling one event at a time."""
+    os.environ.update(env)
+    os.environ['SNAPSHOT_DB_PATH'] = os.path.join(env['LOADTEST_DIR'], str(index), 'db.sqlite3')
+    os.makedirs(os.path.dirname(os.environ['SNAPSHOT_DB_PATH']), exist_ok=True)
+    sys.path.insert(0, MYSITE_DIR)
+    if not verbose:
+        sys.stdout = sys.stderr = open(os.devnull, 'w')
+
+    from mysite import metrics
+    from mysite import wsgi
+
+    # Keep the retry count of each invocation before it's flushed
+    invocation = {}
+    flush = metrics.flush
+
+    def capture_flush():
+        invocation['retries'] = metrics.metrics.values.get('Retries', [0])[-1]
+        flush()
+    metrics.flush = capture_flush
+
+    results.put({'ready': index})
+    while (task := tasks.get()) is not None:
+        method, username, password = task
+        if method == 'POST':
+            event = make_login_event(username, password)
+        else:
+            event = make_event('GET', '/')
+        invocation.clear()
+        result = {'container': index, 'method': method}
+        start = time.perf_counter()
+        try:
+            response = wsgi.lambda_handler(event, {})
+            result['status'] = response['statusCode']
+            result['session'] = get_session_key(response) if method == 'POST' else None
+        except Exception as e:
+            result['status'] = None
+            result['error'] = repr(e)
+        result['latency'] = time.perf_counter() - start
+        result['retries'] = invocation.get('retries', 0)
+        results.put(result)
+
+
+def run_containers(count, env, tasks, args):
+    """Start count containers and wait until they've all started up."""
+    context = multiprocessing.get_context('spawn')
+    task_queue, results = context.Queue(), context.Queue()
+    processes = [context.Process(target=run_container,
+                                 args=(index, env, task_queue, results, args.verbose))
+                 for index in range(count)]
+    for process in processes:
+        process.start()
+    for _ in processes:
+        results.get()
+    start = time.perf_counter()
+    for task in tasks:
+        task_queue.put(task)
+    for _ in processes:
+        task_queue.put(None)
+    collected = [results.get() for _ in tasks]
+    elapsed = time.perf_counter() - start
+    for process in processes:
+        process.join()
+    return collected, elapsed
+
+
+def get_committed_sessions(session_keys, work_dir) -> set:
+    """Rebuild the latest snapshot and return which session keys it holds."""
+    if os.environ.get('DYNAMODB_SESSIONS_TABLE_NAME'):
+        # Sessions never reach the snapshot, check the session table instead
+        dynamodb = boto3.client('dynamodb')
+        return {session_key for session_key in session_keys if 'Item' in dynamodb.get_item(
+            TableName=os.environ['DYNAMODB_SESSIONS_TABLE_NAME'],
+            Key={'session_key': {'S': session_key}})}
+
+    from mysite.snapshot_deltas import apply_delta
+    from mysite.snapshot_transfer import download_snapshot_object
+
+    # Sessions are a churn table, they live in the churn chain (mysite.churn)
+    churn = os.environ.get('SNAPSHOT_CHURN_DB') == 'True'
+    bucket_name = os.environ['BUCKET_NAME']
+    response = boto3.client('dynamodb').query(
+        TableName=os.environ['TABLE_NAME'],
+        KeyConditionExpression='domainName = :domainName',
+        ExpressionAttributeValues={':domainName': {'S': 'example.com#churn' if churn else 'example.com'}},
+        ScanIndexForward=False, Limit=1)
+    item = response['Items'][0]
+    s3 = boto3.client('s3')
+    db_path = os.path.join(work_dir, 'latest.sqlite3')
+    download_snapshot_object(s3, bucket_name, item['s3Path']['S'], db_path, item['s3VersionId']['S'])
+    for delta in item.get('deltas', {}).get('L', []):
+        apply_delta(db_path, s3.get_object(Bucket=bucket_name, Key=delta['S'])['Body'].read())
+    connection = sqlite3.connect(db_path)
+    try:
+        rows = connection.execute('SELECT session_key FROM django_session').fetchall()
+    finally:
+        connection.close()
+    return {row[0] for row in rows} & set(session_keys)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, round(fraction * (len(values) - 1)))]
+
+
+def summarise(results, elapsed, committed) -> dict:
+    summary = {
+        'requests': len(results),
+        'seconds': round(elapsed, 3),
+        'throughput': round(len(results) / elapsed, 2),
+        'errors': sum(1 for result in results if result['status'] is None
+                      or result['status'] >= 500),
+    }
+    for method in ['GET', 'POST']:
+        latencies = [result['latency'] for result in results if result['method'] == method]
+        summary[method] = {
+            'count': len(latencies),
+            'p50_ms': round(percentile(latencies, 0.5) * 1000, 1) if latencies else None,
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+        }
+    writes = [result for result in results if result['method'] == 'POST' and result['session']]
+    summary['writes'] = len(writes)
+    summary['conflict_rate'] = round(
+        sum(1 for result in writes if result['retries']) / len(writes), 3) if writes else 0
+    summary['retries_per_write'] = round(
+        sum(result['retries'] for result in writes) / len(writes), 3) if writes else 0
+    summary['lost_updates'] = len(writes) - len(committed)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the snapshot sync protocol locally.')
+    parser.add_argument('--containers', type=int, default=4,
+                        help='Number of concurrent simulated Lambda containers.')
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--post-ratio', type=float, default=0.2,
+                        help='Fraction of requests that are writes (admin logins).')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--endpoint-url', default=None,
+                        help='Use already running S3/DynamoDB/Secrets Manager stand-ins.')
+    parser.add_argument('--write-lease', action='store_true',
+                        help='Run with SNAPSHOT_WRITE_LEASE on.')
+    parser.add_argument('--lazy-reads', action='store_true',
+                        help='Run with SNAPSHOT_LAZY_READS on.')
+    parser.add_argument('--dynamodb-sessions', action='store_true',
+                        help='Keep sessions in a DynamoDB table (mysite.dynamodb_sessions).')
+    parser.add_argument('--churn-db', action='store_true',
+                        help='Run with SNAPSHOT_CHURN_DB on, sessions sync in their own chain.')
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='loadtest')
+    parser.add_argument('--json', help='Also write the summary to this file.')
+    parser.add_argument('--verbose', action='store_true',
+                        help="Show the containers' own output.")
+    args = parser.parse_args()
+
+    server = None
+    endpoint_url = args.endpoint_url
+    if not endpoint_url:
+        from moto.server import ThreadedMotoServer
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        port = get_free_port()
+        server = ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+        server.start()
+        endpoint_url = f'http://127.0.0.1:{port}'
+
+    run_id = uuid.uuid4().hex[:8]
+    work_dir = tempfile.mkdtemp(prefix='loadtest-')
+    env = {
+        'AWS_ENDPOINT_URL': endpoint_url,
+        'AWS_DEFAULT_REGION': os.environ.get('AWS_DEFAULT_REGION', 'us-east-1'),
+        'AWS_ACCESS_KEY_ID': os.environ.get('AWS_ACCESS_KEY_ID', 'loadtest'),
+        'AWS_SECRET_ACCESS_KEY': os.environ.get('AWS_SECRET_ACCESS_KEY', 'loadtest'),
+        'BUCKET_NAME': f'loadtest-{run_id}',
+        'TABLE_NAME': f'loadtest-{run_id}',
+        'AWS_LAMBDA_FUNCTION_NAME': 'loadtest',
+        'SNAPSHOT_WRITE_LEASE': str(args.write_lease),
+        'SNAPSHOT_LAZY_READS': str(args.lazy_reads),
+        'SNAPSHOT_CHURN_DB': str(args.churn_db),
+        'LOADTEST_DIR': work_dir,
+    }
+    if args.dynamodb_sessions:
+        env['DYNAMODB_SESSIONS_TABLE_NAME'] = f'loadtest-{run_id}-sessions'
+
+    os.environ.update(env)
+    sys.path.insert(0, MYSITE_DIR)
+
+    try:
+        set_up_stand_ins(args)
+        # The first request initialises the database, do it before the
+        # containers race each other to create it.
+        run_containers(1, {**env, 'LOADTEST_DIR': os.path.join(work_dir, 'init')},
+                       [('GET', None, None)], args)
+
+        rng = random.Random(args.seed)
+        tasks = [('POST' if rng.random() < args.post_ratio else 'GET',
+                  args.username, args.password) for _ in range(args.requests)]
+        results, elapsed = run_containers(args.containers, env, tasks, args)
+
+        session_keys = [result['session'] for result in results if result.get('session')]
+        committed = get_committed_sessions(session_keys, work_dir)
+        summary = summarise(results, elapsed, committed)
+        summary.update(containers=args.containers, post_ratio=args.post_ratio,
+                       write_lease=args.write_lease, lazy_reads=args.lazy_reads,
+                       dynamodb_sessions=args.dynamodb_sessions, churn_db=args.churn_db)
+    finally:
+        if server:
+            server.stop()
+
+    for key, value in summary.items():
+        print(f'{key:>18}: {value}')
+    errors = [result['error'] for result in results if result.get('error')]
+    if errors:
+        print('First error:', errors[0])
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summary, f, indent=2)
+    return 1 if summary['lost_updates'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,148 @@
+"""
+Row level changesets for snapshot writes.
+
+Records the INSERT/UPDATE/DELETE statements a request commits so that, when
+another writer wins the version race, the same change can be replayed onto
+the newer snapshot instead of re-running the whole request.
+
+UPDATE and DELETE statements also record a hash of the rows they were about
+to change (their pre-image: the rowids and, for an UPDATE, the columns it
+sets). A replay onto rows another writer changed in the meantime, even to
+the same number of rows, is a conflict rather than a lost update.
+"""
+import hashlib
+import re
+
+from django.db import connections, transaction
+
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+# Table, SET and WHERE clauses of the UPDATE and DELETE statements Django writes
+UPDATE = re.compile(r'^\s*UPDATE\s+("[^"]+")\s+SET\s+(.*?)(?:\s+WHERE\s+(.*))?$', re.IGNORECASE | re.DOTALL)
+DELETE = re.compile(r'^\s*DELETE\s+FROM\s+("[^"]+")(?:\s+WHERE\s+(.*))?$', re.IGNORECASE | re.DOTALL)
+SET_COLUMN = re.compile(r'(?:^|,\s*)("[^"]+")\s*=')
+
+
+class ChangesetConflict(Exception):
+    pass
+
+
+def is_write_statement(sql) -> bool:
+    return sql.lstrip()[:7].upper().startswith(WRITE_STATEMENTS)
+
+
+def is_insert(sql) -> bool:
+    return sql.lstrip()[:7].upper().startswith(('INSERT', 'REPLACE'))
+
+
+def returns_rowid(sql, connection) -> bool:
+    """
+    Whether the caller sees the rowid an INSERT produced. Django reads back
+    auto primary keys with RETURNING (or lastrowid on older SQLite), rows
+    with an explicit key like sessions don't care which rowid they land on.
+    """
+    return not connection.features.can_return_columns_from_insert or 'RETURNING' in sql
+
+
+def get_last_insert_rowid(connection) -> int:
+    return connection.connection.execute('SELECT last_insert_rowid()').fetchone()[0]
+
+
+def get_pre_image(sql, params, connection):
+    """
+    Hash of the rows an UPDATE or DELETE is about to change, None for other
+    statements or SQL it can't tell the rows of.
+    """
+    match = UPDATE.match(sql)
+    if match is not None:
+        table, where = match.group(1), match.group(3) or '1'
+        # Columns it doesn't set can change meanwhile without being lost
+        columns = ', '.join(['rowid'] + SET_COLUMN.findall(match.group(2)))
+    else:
+        match = DELETE.match(sql)
+        if match is None:
+            return None
+        table, where, columns = match.group(1), match.group(2) or '1', '*'
+    # The WHERE clause comes last, so do its parameters
+    where_params = list(params or [])[len(params or []) - where.count('%s'):] if '%s' in where else []
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT {columns} FROM {table} WHERE {where} ORDER BY rowid', where_params)
+            rows = cursor.fetchall()
+    except Exception:
+        return None
+    return hashlib.sha1(repr(rows).encode()).hexdigest()
+
+
+class ChangesetRecorder:
+    """
+    Django execute wrapper recording committed write statements along with
+    the rows they touched (and the rowid an INSERT produced) so a replay can
+    tell whether it had the same effect on a different snapshot.
+    """
+
+    def __init__(self):
+        self.statements = []
+
+    def __call__(self, execute, sql, params, many, context):
+        if many and is_write_statement(sql):
+            # executemany may be handed a generator, keep a replayable copy
+            params = list(params)
+        # Rows of an executemany are told apart by their rowcount only
+        pre_image = None if many else get_pre_image(sql, params, context['connection'])
+        result = execute(sql, params, many, context)
+        if is_write_statement(sql):
+            insert = is_insert(sql)
+            statement = {
+                'sql': sql,
+                'params': params,
+                'many': many,
+                # INSERT ... RETURNING hasn't finished yet, but SQLite has
+                # already inserted every row so last_insert_rowid is final.
+                'rowcount': None if insert else context['cursor'].rowcount,
+                'lastrowid': get_last_insert_rowid(context['connection']) if insert else None,
+                'preImage': pre_image,
+            }
+            # Statements rolled back with their transaction or savepoint never
+            # reach the snapshot, so only keep what actually gets committed.
+            transaction.on_commit(
+                lambda: self.statements.append(statement),
+                using=context['connection'].alias)
+        return result
+
+
+def replay_changeset(statements, using='default', check_rowids=True):
+    """
+    Apply recorded statements to the current database in one transaction.
+
+    Raises ChangesetConflict (and rolls everything back) if a statement fails
+    or touches different rows than it did originally, e.g. because another
+    writer already took the primary key or changed the row. With check_rowids
+    False inserts may land on any rowid and rows changed meanwhile are
+    overwritten.
+    """
+    connection = connections[using]
+    try:
+        with transaction.atomic(using=using), connection.cursor() as cursor:
+            for statement in statements:
+                if (check_rowids and statement.get('preImage') is not None
+                        and get_pre_image(statement['sql'], statement['params'], connection) != statement['preImage']):
+                    raise ChangesetConflict(
+                        f"Rows changed since they were written: {statement['sql']}")
+                if statement['many']:
+                    cursor.executemany(statement['sql'], statement['params'])
+                else:
+                    cursor.execute(statement['sql'], statement['params'])
+                if is_insert(statement['sql']):
+                    cursor.fetchall()
+                    if (check_rowids and returns_rowid(statement['sql'], connection)
+                            and get_last_insert_rowid(connection) != statement['lastrowid']):
+                        raise ChangesetConflict(
+                            f"Insert produced a different rowid: {statement['sql']}")
+                elif cursor.rowcount != statement['rowcount']:
+                    raise ChangesetConflict(
+                        f"Statement touched {cursor.rowcount} rows instead of {statement['rowcount']}: {statement['sql']}")
+    except ChangesetConflict:
+        raise
+    except Exception as e:
+        raise ChangesetConflict(str(e)) from e
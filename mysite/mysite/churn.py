@@ -0,0 +1,162 @@
+"""
+High-churn tables kept in a second SQLite file next to the snapshot.
+
+Sessions and the admin and audit logs are written on nearly every admin
+request but never read by the public site, so with SNAPSHOT_CHURN_DB on
+they live in <snapshot>.churn, ATTACHed to every connection as schema churn.
+Unqualified table names fall through to attached databases, so Django and
+Wagtail query them as usual. The churn file has its own version chain and
+is only synced on the write path (see mysite.wsgi), so the snapshot read
+paths download no longer changes for logins and log entries.
+
+SQLite can't enforce foreign keys across databases, so the tables are moved
+without their REFERENCES clauses. Django's migrations can't alter attached
+tables either, they are joined back into the snapshot around migrate.
+"""
+import os
+import re
+import sqlite3
+
+from django.conf import settings
+from django.db import connections
+
+from mysite.changesets import ChangesetConflict, replay_changeset
+
+CHURN_SCHEMA = 'churn'
+
+# Append-mostly, written by logins and admin actions, not read when serving
+# pages. Revisions stay put, wagtailcore_page has foreign keys to them.
+CHURN_TABLES = [
+    'django_session',
+    'django_admin_log',
+    'wagtailcore_pagelogentry',
+    'wagtailcore_modellogentry',
+]
+
+REFERENCES = re.compile(
+    r'\s+REFERENCES\s+"\w+"\s*\("\w+"\)(\s+DEFERRABLE\s+INITIALLY\s+DEFERRED)?', re.IGNORECASE)
+STATEMENT_TABLE = re.compile(
+    r'^\s*(?:(?:INSERT|REPLACE)(?:\s+OR\s+\w+)?\s+INTO|UPDATE|DELETE\s+FROM)\s+"?(\w+)"?',
+    re.IGNORECASE)
+
+
+def get_churn_db_path(db_path) -> str:
+    return f'{db_path}.churn'
+
+
+def attach_churn_db(sender, connection, **kwargs):
+    """connection_created receiver attaching the churn file to the snapshot."""
+    if not settings.SNAPSHOT_CHURN_DB or connection.vendor != 'sqlite':
+        return
+    name = str(connection.settings_dict['NAME'])
+    # The s3vfs backend and in memory test databases have no file next door
+    if connection.settings_dict['ENGINE'] != 'django.db.backends.sqlite3' or 'memory' in name:
+        return
+    if name.startswith('file:'):
+        # Read only requests open the snapshot immutable, same for churn, and
+        # don't download it. Those pages never read churn tables anyway.
+        churn_db_path = get_churn_db_path(name[len('file:'):].split('?')[0])
+        if not os.path.exists(churn_db_path):
+            return
+        churn_db_name = f'file:{churn_db_path}?mode=ro&immutable=1'
+    else:
+        churn_db_name = get_churn_db_path(name)
+    with connection.cursor() as cursor:
+        cursor.execute(f'ATTACH DATABASE %s AS {CHURN_SCHEMA}', [churn_db_name])
+
+
+def get_statement_table(statement):
+    match = STATEMENT_TABLE.match(statement['sql'])
+    return match.group(1) if match else None
+
+
+def get_attached_tables(using='default') -> set:
+    """Churn tables that have actually been moved into the attached file."""
+    with connections[using].cursor() as cursor:
+        cursor.execute(f"SELECT name FROM {CHURN_SCHEMA}.sqlite_master WHERE type = 'table'")
+        return {name for name, in cursor.fetchall()} & set(CHURN_TABLES)
+
+
+def split_changeset(statements, churn_tables) -> tuple:
+    """Split recorded statements into (snapshot, churn) changesets."""
+    snapshot_statements, churn_statements = [], []
+    for statement in statements:
+        if get_statement_table(statement) in churn_tables:
+            churn_statements.append(statement)
+        else:
+            snapshot_statements.append(statement)
+    return snapshot_statements, churn_statements
+
+
+def replay_churn_changeset(statements, using='default'):
+    """
+    Best effort replay of churn statements onto a newer churn database.
+
+    Log rows may land on different ids than they did originally and a
+    statement that conflicts (e.g. a session deleted meanwhile) is skipped
+    rather than failing a write that has already been committed.
+    """
+    for statement in statements:
+        try:
+            replay_changeset([statement], using, check_rowids=False)
+        except ChangesetConflict as e:
+            print(f'Skipping conflicting churn statement: {e}')
+
+
+def has_sequence(connection, schema) -> bool:
+    return connection.execute(
+        f"SELECT 1 FROM {schema}.sqlite_master WHERE name = 'sqlite_sequence'").fetchone() is not None
+
+
+def move_tables(connection, source, target, strip_references=False) -> list:
+    """Move the churn tables (with indexes and sequences) from one schema to the other."""
+    moved = []
+    for table in CHURN_TABLES:
+        objects = connection.execute(
+            f"SELECT type, sql FROM {source}.sqlite_master WHERE tbl_name = ? AND sql IS NOT NULL"
+            " ORDER BY type = 'table' DESC", (table,)).fetchall()
+        if not objects:
+            continue
+        # Left behind in the target by an earlier move, the source is newer
+        connection.execute(f'DROP TABLE IF EXISTS {target}."{table}"')
+        for object_type, sql in objects:
+            if strip_references:
+                sql = REFERENCES.sub('', sql)
+            sql = re.sub(r'^(CREATE (?:UNIQUE )?(?:TABLE|INDEX)) "',
+                         rf'\1 {target}."', sql)
+            connection.execute(sql)
+            if object_type == 'table':
+                connection.execute(
+                    f'INSERT INTO {target}."{table}" SELECT * FROM {source}."{table}"')
+        if has_sequence(connection, source) and has_sequence(connection, target):
+            # Keep AUTOINCREMENT from handing out ids of deleted rows again
+            connection.execute(
+                f'UPDATE {target}.sqlite_sequence SET seq = (SELECT seq FROM {source}.sqlite_sequence'
+                ' WHERE name = ?) WHERE name = ?', (table, table))
+        connection.execute(f'DROP TABLE {source}."{table}"')
+        moved.append(table)
+    return moved
+
+
+def move_churn_tables(db_path, to_churn=True) -> list:
+    """
+    Move the churn tables out of db_path into its churn file, or back into
+    db_path when to_churn is False. No Django connection may be open.
+    Returns the tables moved.
+    """
+    connection = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        connection.execute(f'ATTACH DATABASE ? AS {CHURN_SCHEMA}', (get_churn_db_path(db_path),))
+        connection.execute('BEGIN')
+        if to_churn:
+            moved = move_tables(connection, 'main', CHURN_SCHEMA, strip_references=True)
+        else:
+            moved = move_tables(connection, CHURN_SCHEMA, 'main')
+        connection.execute('COMMIT')
+        if moved:
+            print(f'Moved {", ".join(moved)} into {"churn" if to_churn else "the snapshot"}')
+            # Hand the freed pages back so the snapshot actually shrinks
+            connection.execute('VACUUM main' if to_churn else f'VACUUM {CHURN_SCHEMA}')
+        return moved
+    finally:
+        connection.close()
@@ -0,0 +1,98 @@
+"""
+Session engine storing sessions in DynamoDB instead of the SQLite snapshot.
+
+Use it as SESSION_ENGINE 'mysite.dynamodb_sessions' with the table name in
+DYNAMODB_SESSIONS_TABLE_NAME, so logins, CSRF rotation and session touches
+no longer change db.sqlite3 (and no longer cost a snapshot upload).
+
+Items are keyed by session_key and carry the encoded session in data and its
+expiry in expires (epoch seconds), the table's TTL attribute. TTL deletes
+lazily, so expired items are also ignored on read. boto3 honours
+AWS_ENDPOINT_URL(_DYNAMODB), which is how a local stand-in (DynamoDB Local,
+moto) is used.
+"""
+from functools import lru_cache
+
+import boto3
+from django.conf import settings
+from django.contrib.sessions.backends.base import CreateError, SessionBase, UpdateError
+from django.utils import timezone
+
+
+@lru_cache(maxsize=None)
+def get_dynamodb_client():
+    return boto3.session.Session().client('dynamodb')
+
+
+class SessionStore(SessionBase):
+
+    @property
+    def table_name(self):
+        return settings.DYNAMODB_SESSIONS_TABLE_NAME
+
+    def get_item(self, session_key):
+        response = get_dynamodb_client().get_item(
+            TableName=self.table_name,
+            Key={'session_key': {'S': session_key}},
+            ConsistentRead=True)
+        item = response.get('Item')
+        if item and int(item['expires']['N']) > timezone.now().timestamp():
+            return item
+        return None
+
+    def load(self):
+        item = self.get_item(self.session_key) if self.session_key else None
+        if item is None:
+            self._session_key = None
+            return {}
+        return self.decode(item['data']['S'])
+
+    def exists(self, session_key):
+        return self.get_item(session_key) is not None
+
+    def create(self):
+        while True:
+            self._session_key = self._get_new_session_key()
+            try:
+                # Save immediately to ensure we have a unique entry in the table.
+                self.save(must_create=True)
+            except CreateError:
+                # Key wasn't unique. Try again.
+                continue
+            self.modified = True
+            return
+
+    def save(self, must_create=False):
+        if self.session_key is None:
+            return self.create()
+        data = self._get_session(no_load=must_create)
+        client = get_dynamodb_client()
+        try:
+            client.put_item(
+                TableName=self.table_name,
+                Item={
+                    'session_key': {'S': self.session_key},
+                    'data': {'S': self.encode(data)},
+                    'expires': {'N': str(int(self.get_expiry_date().timestamp()))}
+                },
+                ConditionExpression=('attribute_not_exists(session_key)' if must_create
+                                     else 'attribute_exists(session_key)'))
+        except client.exceptions.ConditionalCheckFailedException:
+            if must_create:
+                raise CreateError
+            # Deleted in the meantime, e.g. by a logout in another request
+            raise UpdateError
+
+    def delete(self, session_key=None):
+        if session_key is None:
+            if self.session_key is None:
+                return
+            session_key = self.session_key
+        get_dynamodb_client().delete_item(
+            TableName=self.table_name,
+            Key={'session_key': {'S': session_key}})
+
+    @classmethod
+    def clear_expired(cls):
+        # DynamoDB's TTL on expires removes them
+        pass
@@ -0,0 +1,89 @@
+"""
+Per invocation timings in CloudWatch embedded metric format (EMF).
+
+Each invocation prints one JSON line and CloudWatch Logs turns its values
+into metrics under METRICS_NAMESPACE, no API calls from the function. A
+phase that runs more than once (e.g. a version lookup per conflict retry)
+reports every duration. The first invocation also carries the startup
+phases and ColdStart.
+"""
+import json
+import os
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'WagtailCms')
+
+
+class InvocationMetrics:
+
+    def __init__(self, cold_start=False):
+        self.values = {}
+        self.units = {}
+        self.properties = {'ColdStart': cold_start}
+
+    def add(self, name, value, unit='Milliseconds'):
+        self.values.setdefault(name, []).append(value)
+        self.units[name] = unit
+
+    def set_property(self, name, value):
+        self.properties[name] = value
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, round((time.perf_counter() - start) * 1000, 3))
+
+    def to_emf(self) -> dict:
+        return {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [[]],
+                    'Metrics': [{'Name': name, 'Unit': unit}
+                                for name, unit in self.units.items()]
+                }]
+            },
+            **self.properties,
+            **{name: values[0] if len(values) == 1 else values
+               for name, values in self.values.items()}
+        }
+
+
+# Collects everything since the last flush, starting with the cold start
+metrics = InvocationMetrics(cold_start=True)
+
+
+def add(name, value, unit='Milliseconds'):
+    metrics.add(name, value, unit)
+
+
+def set_property(name, value):
+    metrics.set_property(name, value)
+
+
+def phase(name):
+    return metrics.phase(name)
+
+
+def timed(name):
+    """Decorator recording every call of the function as phase name."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def flush():
+    """Print the metrics collected so far and start collecting afresh."""
+    global metrics
+    flushed, metrics = metrics, InvocationMetrics()
+    print(json.dumps(flushed.to_emf(), default=str))
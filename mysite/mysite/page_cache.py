@@ -0,0 +1,205 @@
+"""
+Full page cache for anonymous reads, keyed by snapshot version.
+
+Pages only change when the snapshot does, so a rendered response stays
+valid for as long as the container serves the same version. Entries are
+keyed by site, path, query string and the few request headers a response
+can depend on, and live in an in-process LRU backed by a second, larger
+LRU on disk next to the snapshot. A new version drops both.
+
+Only plain public responses are kept: a 200 that sets no cookie, doesn't
+vary on Cookie and isn't marked private or uncacheable. A hit whose ETag
+matches the request's If-None-Match is answered with a 304, as the view's
+condition decorator would have.
+"""
+import hashlib
+import json
+import os
+import shutil
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.utils.http import parse_etags
+
+from mysite import metrics
+
+PAGE_CACHE_MEMORY_BYTES = int(os.environ.get('PAGE_CACHE_MEMORY_BYTES', 32 * 1024 * 1024))
+PAGE_CACHE_DISK_BYTES = int(os.environ.get('PAGE_CACHE_DISK_BYTES', 128 * 1024 * 1024))
+MAX_ENTRY_BYTES = 2 * 1024 * 1024
+
+# Request headers that can change the response to an anonymous GET, the
+# site itself is keyed by Host.
+KEY_HEADERS = ['accept-encoding', 'x-forwarded-proto', 'x-forwarded-port']
+UNCACHEABLE_DIRECTIVES = ['private', 'no-cache', 'no-store']
+# Headers a 304 keeps, as django.utils.cache does
+NOT_MODIFIED_HEADERS = ['cache-control', 'content-location', 'date', 'etag', 'expires', 'last-modified', 'vary']
+
+# Version key of the snapshot the current read only request renders, e.g. for
+# ETags (see cms.views.recipe_catalog). None on writes and outside Lambda.
+current_version_key = None
+
+
+def get_version_key(version_info) -> str:
+    """Identifies one snapshot version, base plus deltas."""
+    deltas = version_info['deltas']
+    identity = f"{version_info['version']}/{version_info['s3VersionId']}/{deltas[-1] if deltas else ''}"
+    return hashlib.sha1(identity.encode()).hexdigest()[:16]
+
+
+@contextmanager
+def rendering_version(version_info):
+    global current_version_key
+    current_version_key = get_version_key(version_info)
+    try:
+        yield
+    finally:
+        current_version_key = None
+
+
+def get_current_version_key():
+    return current_version_key
+
+
+def get_page_key(event) -> str:
+    headers = {key.lower(): value for key, value in (event.get('headers') or {}).items()}
+    query = event.get('multiValueQueryStringParameters') or {
+        name: [value] for name, value in (event.get('queryStringParameters') or {}).items()}
+    key = [
+        event.get('httpMethod'),
+        headers.get('host', ''),
+        event.get('path'),
+        sorted((name, sorted(values)) for name, values in query.items()),
+        [headers.get(header, '') for header in KEY_HEADERS],
+    ]
+    return hashlib.sha256(json.dumps(key).encode()).hexdigest()
+
+
+def get_response_headers(response) -> dict:
+    headers = {key.lower(): ', '.join(values)
+               for key, values in (response.get('multiValueHeaders') or {}).items()}
+    headers.update({key.lower(): value for key, value in (response.get('headers') or {}).items()})
+    return headers
+
+
+def is_cacheable(event, response) -> bool:
+    headers = {key.lower() for key in (event.get('headers') or {})}
+    if 'authorization' in headers or response.get('statusCode') != 200:
+        return False
+    response_headers = get_response_headers(response)
+    cache_control = response_headers.get('cache-control', '').lower()
+    return ('set-cookie' not in response_headers
+            and 'cookie' not in response_headers.get('vary', '').lower()
+            and not any(directive in cache_control for directive in UNCACHEABLE_DIRECTIVES))
+
+
+def get_not_modified(event, response):
+    """A 304 for a cached response whose ETag the request already has, or None."""
+    headers = {key.lower(): value for key, value in (event.get('headers') or {}).items()}
+    etag = get_response_headers(response).get('etag')
+    if not etag or 'if-none-match' not in headers:
+        return None
+    etags = parse_etags(headers['if-none-match'])
+    # Weak comparison, like django.utils.cache
+    if '*' not in etags and etag.removeprefix('W/') not in [tag.removeprefix('W/') for tag in etags]:
+        return None
+    header_field = 'multiValueHeaders' if 'multiValueHeaders' in response else 'headers'
+    return {
+        'statusCode': 304,
+        header_field: {key: value for key, value in (response.get(header_field) or {}).items()
+                       if key.lower() in NOT_MODIFIED_HEADERS},
+        'body': '',
+        'isBase64Encoded': False,
+    }
+
+
+def mark_hit(response) -> dict:
+    header_field = 'multiValueHeaders' if 'multiValueHeaders' in response else 'headers'
+    headers = dict(response.get(header_field) or {})
+    headers['X-Page-Cache'] = ['hit'] if header_field == 'multiValueHeaders' else 'hit'
+    return {**response, header_field: headers}
+
+
+class PageCache:
+    """Rendered responses of one snapshot version, in memory and on disk."""
+
+    def __init__(self, cache_dir, memory_bytes=PAGE_CACHE_MEMORY_BYTES,
+                 disk_bytes=PAGE_CACHE_DISK_BYTES):
+        self.cache_dir = cache_dir
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.version_key = None
+        self.memory = OrderedDict()
+        self.memory_used = 0
+        self.disk = OrderedDict()
+        self.disk_used = 0
+
+    def use_version(self, version_key):
+        if version_key == self.version_key:
+            return
+        # Everything cached so far rendered an older version
+        self.memory.clear()
+        self.memory_used = 0
+        self.disk.clear()
+        self.disk_used = 0
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        self.version_key = version_key
+
+    def get(self, version_info, event):
+        self.use_version(get_version_key(version_info))
+        key = get_page_key(event)
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            metrics.add('PageCacheHits', 1, 'Count')
+            return mark_hit(json.loads(self.memory[key]))
+        if key in self.disk:
+            self.disk.move_to_end(key)
+            with open(os.path.join(self.cache_dir, key), 'rb') as f:
+                entry = f.read()
+            self.put_in_memory(key, entry)
+            metrics.add('PageCacheHits', 1, 'Count')
+            return mark_hit(json.loads(entry))
+        metrics.add('PageCacheMisses', 1, 'Count')
+        return None
+
+    def put(self, version_info, event, response):
+        if not is_cacheable(event, response):
+            return
+        entry = json.dumps(response).encode()
+        if len(entry) > MAX_ENTRY_BYTES:
+            return
+        self.use_version(get_version_key(version_info))
+        key = get_page_key(event)
+        self.put_in_memory(key, entry)
+        self.put_on_disk(key, entry)
+
+    def put_in_memory(self, key, entry):
+        self.memory_used += len(entry) - len(self.memory.get(key, b''))
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        evictions = 0
+        while self.memory_used > self.memory_bytes:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_used -= len(evicted)
+            evictions += 1
+        if evictions:
+            metrics.add('PageCacheEvictions', evictions, 'Count')
+
+    def put_on_disk(self, key, entry):
+        if len(entry) > self.disk_bytes:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = os.path.join(self.cache_dir, key)
+        with open(f'{path}.tmp', 'wb') as f:
+            f.write(entry)
+        os.replace(f'{path}.tmp', path)
+        self.disk_used += len(entry) - self.disk.get(key, 0)
+        self.disk[key] = len(entry)
+        self.disk.move_to_end(key)
+        evictions = 0
+        while self.disk_used > self.disk_bytes:
+            evicted, size = self.disk.popitem(last=False)
+            os.remove(os.path.join(self.cache_dir, evicted))
+            self.disk_used -= size
+            evictions += 1
+        if evictions:
+            metrics.add('PageCacheDiskEvictions', evictions, 'Count')
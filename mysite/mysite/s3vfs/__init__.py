@@ -0,0 +1,10 @@
+"""
+Read-only SQLite backend that pages the snapshot lazily from S3.
+
+Use it as ENGINE 'mysite.s3vfs'. SQLite page reads are served through an
+apsw VFS from the versioned snapshot object with HTTP range requests, so an
+anonymous page render only fetches the blocks it actually touches instead of
+the whole database. Fetched blocks are kept in /tmp across warm invocations.
+
+apsw is an optional dependency, the stdlib sqlite3 module can't plug in a VFS.
+"""
@@ -0,0 +1,211 @@
+"""
+Django backend for the lazily paged snapshot.
+
+Reuses the sqlite3 backend for everything but the connection itself, which
+is an apsw connection on the s3vfs VFS behind a thin DB-API adapter. Errors
+are raised as their sqlite3 equivalents so Django wraps them as usual.
+"""
+import datetime
+import decimal
+import functools
+import sqlite3
+from collections.abc import Mapping
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.sqlite3 import base as sqlite3_base
+from django.db.backends.sqlite3._functions import register as register_functions
+from django.db.backends.sqlite3.base import FORMAT_QMARK_REGEX
+
+try:
+    import apsw
+except ImportError as e:
+    raise ImproperlyConfigured(f'Error loading apsw module: {e}')
+
+from mysite.s3vfs import vfs  # noqa: E402
+
+ERRORS = {
+    apsw.ConstraintError: sqlite3.IntegrityError,
+    apsw.ReadOnlyError: sqlite3.OperationalError,
+    apsw.SQLError: sqlite3.OperationalError,
+    apsw.BusyError: sqlite3.OperationalError,
+    apsw.LockedError: sqlite3.OperationalError,
+    apsw.IOError: sqlite3.OperationalError,
+    apsw.CantOpenError: sqlite3.OperationalError,
+    apsw.TooBigError: sqlite3.DataError,
+    apsw.MismatchError: sqlite3.IntegrityError,
+    apsw.BindingsError: sqlite3.ProgrammingError,
+}
+
+
+def translate_errors(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except apsw.Error as e:
+            raise ERRORS.get(type(e), sqlite3.DatabaseError)(str(e)) from e
+    return wrapper
+
+
+def adapt(value):
+    # The same adapters Django registers with the sqlite3 module
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(' ')
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return value
+
+
+def adapt_params(params):
+    if params is None:
+        return None
+    if isinstance(params, Mapping):
+        return {name: adapt(value) for name, value in params.items()}
+    return tuple(adapt(value) for value in params)
+
+
+def convert_query(query, params):
+    if isinstance(params, Mapping):
+        return query % {name: f':{name}' for name in params}
+    return FORMAT_QMARK_REGEX.sub('?', query).replace('%%', '%')
+
+
+class Cursor:
+    """The slice of the sqlite3 cursor API Django uses, on top of apsw."""
+
+    arraysize = 1
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.cursor = connection.apsw_connection.cursor()
+        self.description = None
+        self.rows = iter(())
+
+    @translate_errors
+    def execute(self, query, params=None):
+        if params is not None:
+            query = convert_query(query, params)
+        self.rows = self.cursor.execute(query, adapt_params(params))
+        try:
+            self.description = self.cursor.description
+        except apsw.ExecutionCompleteError:
+            # Nothing to read, apsw only describes statements still running
+            self.description = None
+        return self
+
+    @translate_errors
+    def executemany(self, query, param_list):
+        param_list = [adapt_params(params) for params in param_list]
+        if param_list:
+            query = convert_query(query, param_list[0])
+        self.rows = self.cursor.executemany(query, param_list)
+        self.description = None
+        return self
+
+    @property
+    def rowcount(self):
+        return self.connection.apsw_connection.changes()
+
+    @property
+    def lastrowid(self):
+        return self.connection.apsw_connection.last_insert_rowid()
+
+    @translate_errors
+    def fetchone(self):
+        return next(self.rows, None)
+
+    @translate_errors
+    def fetchmany(self, size=None):
+        rows = []
+        for row in self.rows:
+            rows.append(row)
+            if len(rows) >= (size or self.arraysize):
+                break
+        return rows
+
+    @translate_errors
+    def fetchall(self):
+        return list(self.rows)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+    def close(self):
+        self.cursor.close()
+
+
+class Connection:
+    """The slice of the sqlite3 connection API Django uses, on top of apsw."""
+
+    isolation_level = None
+
+    def __init__(self, name):
+        self.apsw_connection = apsw.Connection(
+            name, flags=apsw.SQLITE_OPEN_READONLY, vfs=vfs.VFS_NAME)
+
+    def cursor(self):
+        return Cursor(self)
+
+    def execute(self, query, params=None):
+        return self.cursor().execute(query, params)
+
+    def create_function(self, name, num_params, func, deterministic=False):
+        self.apsw_connection.create_scalar_function(
+            name, func, num_params, deterministic=deterministic)
+
+    def create_aggregate(self, name, num_params, aggregate_class):
+        def factory():
+            aggregate = aggregate_class()
+            return (aggregate,
+                    lambda context, *args: context.step(*args),
+                    lambda context: context.finalize())
+        self.apsw_connection.create_aggregate_function(name, factory, num_params)
+
+    @property
+    def in_transaction(self):
+        return not self.apsw_connection.get_autocommit()
+
+    def commit(self):
+        # Nothing is ever written through a read-only connection
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.apsw_connection.close()
+
+
+class DatabaseWrapper(sqlite3_base.DatabaseWrapper):
+    vendor = 'sqlite'
+    display_name = 'SQLite (lazily paged from S3)'
+
+    def get_connection_params(self):
+        if not self.settings_dict['NAME']:
+            raise ImproperlyConfigured(
+                'settings.DATABASES is improperly configured. '
+                'Please supply the NAME value.')
+        return {'name': self.settings_dict['NAME']}
+
+    @translate_errors
+    def get_new_connection(self, conn_params):
+        if vfs.vfs is None or vfs.vfs.snapshot is None:
+            raise ImproperlyConfigured(
+                'Select a snapshot with mysite.s3vfs.vfs.set_snapshot() first.')
+        conn = Connection(conn_params['name'])
+        register_functions(conn)
+        return conn
+
+    def create_cursor(self, name=None):
+        return self.connection.cursor()
+
+    def is_usable(self):
+        return True
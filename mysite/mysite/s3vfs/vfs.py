@@ -0,0 +1,233 @@
+"""
+The SQLite VFS behind the s3vfs backend.
+
+The base snapshot is read block by block: gzipped snapshots are fully
+flushed every BLOCK_SIZE bytes (see mysite.snapshot_transfer), so a block
+is one ranged GET of the offsets in the block index, plain objects are
+ranged directly. Pages changed by the delta chain are overlaid in memory.
+"""
+import json
+import os
+import shutil
+import zlib
+from collections import OrderedDict
+
+import apsw
+
+from mysite.snapshot_deltas import read_delta
+from mysite.snapshot_transfer import get_index_key
+
+VFS_NAME = 's3vfs'
+CACHE_DIR = '/tmp/s3vfs'
+MEMORY_CACHE_BLOCKS = 64
+
+
+class SnapshotNotPageable(Exception):
+    pass
+
+
+class LazySnapshot:
+    """One version of the snapshot (base plus deltas), readable at any offset."""
+
+    def __init__(self, s3_client, bucket_name, object_key, s3_version_id, deltas=()):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.object_key = object_key
+        self.s3_version_id = s3_version_id
+        self.index = self.load_index()
+        self.size = self.index['size']
+        self.block_size = self.index['blockSize']
+        self.cache_dir = os.path.join(CACHE_DIR, s3_version_id)
+        self.blocks = OrderedDict()
+        self.deltas = []
+        self.pages = {}
+        self.page_size = None
+        self.apply_deltas(deltas)
+
+    def load_index(self) -> dict:
+        try:
+            response = self.s3_client.get_object(
+                Bucket=self.bucket_name,
+                Key=get_index_key(self.object_key, self.s3_version_id))
+            return json.loads(response['Body'].read())
+        except self.s3_client.exceptions.NoSuchKey:
+            pass
+        head = self.s3_client.head_object(
+            Bucket=self.bucket_name, Key=self.object_key, VersionId=self.s3_version_id)
+        if head.get('Metadata', {}).get('snapshot-format'):
+            # Compressed before block indexes existed, can't be ranged
+            raise SnapshotNotPageable(self.s3_version_id)
+        return {'format': 'plain', 'blockSize': 256 * 1024, 'size': head['ContentLength']}
+
+    def can_catch_up(self, s3_version_id, deltas) -> bool:
+        return (s3_version_id == self.s3_version_id
+                and list(deltas[:len(self.deltas)]) == self.deltas)
+
+    def apply_deltas(self, deltas):
+        for object_key in deltas[len(self.deltas):]:
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=object_key)
+            page_size, page_count, pages = read_delta(response['Body'].read())
+            self.pages.update(pages)
+            self.page_size = page_size
+            self.size = page_count * page_size
+            self.deltas.append(object_key)
+        if self.page_size:
+            page_count = self.size // self.page_size
+            self.pages = {number: page for number,
+                          page in self.pages.items() if number < page_count}
+
+    def read(self, amount, offset) -> bytes:
+        end = min(offset + amount, self.size)
+        data = bytearray()
+        while offset < end:
+            if self.page_size and offset // self.page_size in self.pages:
+                page_start = offset - offset % self.page_size
+                page = self.pages[offset // self.page_size]
+                chunk = page[offset - page_start:end - page_start]
+            else:
+                block_start = offset - offset % self.block_size
+                block = self.get_block(offset // self.block_size)
+                chunk = block[offset - block_start:end - block_start]
+                if self.page_size:
+                    # Stop at the next page that a delta may have replaced
+                    next_page = (offset // self.page_size + 1) * self.page_size
+                    chunk = chunk[:next_page - offset]
+            if not chunk:
+                # Pages past the end of the base that no delta provided
+                chunk = bytes(end - offset)
+            data += chunk
+            offset += len(chunk)
+        return bytes(data)
+
+    def get_block(self, block_number) -> bytes:
+        if block_number in self.blocks:
+            self.blocks.move_to_end(block_number)
+            return self.blocks[block_number]
+        path = os.path.join(self.cache_dir, str(block_number))
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                block = f.read()
+        else:
+            block = self.fetch_block(block_number)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(f'{path}.download', 'wb') as f:
+                f.write(block)
+            os.replace(f'{path}.download', path)
+        self.blocks[block_number] = block
+        if len(self.blocks) > MEMORY_CACHE_BLOCKS:
+            self.blocks.popitem(last=False)
+        return block
+
+    def fetch_block(self, block_number) -> bytes:
+        if self.index['format'] == 'gzip':
+            offsets = self.index['offsets']
+            if block_number + 1 >= len(offsets):
+                return b''
+            start, end = offsets[block_number], offsets[block_number + 1] - 1
+        else:
+            start = block_number * self.block_size
+            end = min(start + self.block_size, self.index['size']) - 1
+            if start > end:
+                return b''
+        response = self.s3_client.get_object(
+            Bucket=self.bucket_name, Key=self.object_key,
+            VersionId=self.s3_version_id, Range=f'bytes={start}-{end}')
+        data = response['Body'].read()
+        if self.index['format'] == 'gzip':
+            return zlib.decompressobj(-zlib.MAX_WBITS).decompress(data)
+        return data
+
+
+def remove_stale_caches(s3_version_id):
+    """Cached blocks of older base snapshots are never read again."""
+    if not os.path.isdir(CACHE_DIR):
+        return
+    for name in os.listdir(CACHE_DIR):
+        if name != s3_version_id:
+            shutil.rmtree(os.path.join(CACHE_DIR, name), ignore_errors=True)
+
+
+class SnapshotFile:
+    """apsw VFS file serving reads from the current LazySnapshot."""
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def xRead(self, amount, offset):
+        return self.snapshot.read(amount, offset)
+
+    def xFileSize(self):
+        return self.snapshot.size
+
+    def xWrite(self, data, offset):
+        raise apsw.ReadOnlyError('attempt to write a readonly database')
+
+    def xTruncate(self, newsize):
+        raise apsw.ReadOnlyError('attempt to write a readonly database')
+
+    def xSync(self, flags):
+        pass
+
+    def xLock(self, level):
+        pass
+
+    def xUnlock(self, level):
+        pass
+
+    def xCheckReservedLock(self):
+        return False
+
+    def xFileControl(self, op, ptr):
+        return False
+
+    def xSectorSize(self):
+        return 4096
+
+    def xDeviceCharacteristics(self):
+        return apsw.SQLITE_IOCAP_IMMUTABLE
+
+    def xClose(self):
+        pass
+
+
+class SnapshotVFS(apsw.VFS):
+    """Opens every database name as the current snapshot, read only."""
+
+    def __init__(self):
+        self.snapshot = None
+        super().__init__(VFS_NAME, base='')
+
+    def xOpen(self, name, flags):
+        if self.snapshot is None:
+            raise apsw.CantOpenError('No snapshot selected')
+        return SnapshotFile(self.snapshot)
+
+    def xAccess(self, pathname, flags):
+        # No journal or WAL can exist next to an immutable snapshot
+        return not str(pathname).endswith(('-journal', '-wal', '-shm'))
+
+    def xFullPathname(self, name):
+        return name
+
+    def xDelete(self, filename, syncdir):
+        pass
+
+
+vfs = None
+
+
+def set_snapshot(s3_client, bucket_name, object_key, s3_version_id, deltas=()):
+    """
+    Point the VFS at a snapshot version, reusing the blocks and deltas
+    already loaded when only new deltas were added on top of the same base.
+    Raises SnapshotNotPageable if the base can't be read by ranges.
+    """
+    global vfs
+    if vfs is None:
+        vfs = SnapshotVFS()
+    if vfs.snapshot and vfs.snapshot.can_catch_up(s3_version_id, deltas):
+        vfs.snapshot.apply_deltas(deltas)
+    else:
+        vfs.snapshot = LazySnapshot(s3_client, bucket_name, object_key,
+                                    s3_version_id, deltas)
+        remove_stale_caches(s3_version_id)
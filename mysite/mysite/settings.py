@@ -42,6 +42,7 @@ INSTALLED_APPS = [
     "django_s3_sqlite",
     'wagtail.contrib.forms',
     'wagtail.contrib.redirects',
+    'wagtail.contrib.routable_page',
     'wagtail.embeds',
     'wagtail.sites',
     'wagtail.users',
@@ -105,13 +106,32 @@ TEMPLATES = [
 WSGI_APPLICATION = 'mysite.wsgi.application'
 
 
+# Local copy of the snapshot, overridable so several simulated containers
+# can share one machine (see loadtest.py)
+SNAPSHOT_DB_PATH = os.environ.get('SNAPSHOT_DB_PATH', '/tmp/db.sqlite3')
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': '/tmp/db.sqlite3',
+        'NAME': SNAPSHOT_DB_PATH,
     }
 }
 
+# Sessions and admin/audit logs live in a separately synced file ATTACHed
+# next to the snapshot (see mysite.churn).
+SNAPSHOT_CHURN_DB = str_to_bool(os.environ.get('SNAPSHOT_CHURN_DB', 'False'))
+
+# Sessions live in DynamoDB when the stack provides a table, so logins and
+# session touches don't change the snapshot.
+DYNAMODB_SESSIONS_TABLE_NAME = os.environ.get('DYNAMODB_SESSIONS_TABLE_NAME')
+if DYNAMODB_SESSIONS_TABLE_NAME:
+    SESSION_ENGINE = 'mysite.dynamodb_sessions'
+
+# Published pages are exported as HTML under this prefix of the bucket and
+# served by CloudFront without invoking Lambda (see cms.static_export).
+STATIC_EXPORT_PREFIX = os.environ.get('STATIC_EXPORT_PREFIX')
+STATIC_EXPORT_BUCKET_NAME = os.environ.get('BUCKET_NAME')
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -0,0 +1,61 @@
+"""
+Work deferred until the snapshot version a write produced is committed.
+
+transaction.on_commit fires on the local SQLite commit, before the write
+path has uploaded the snapshot and committed its version in DynamoDB (see
+mysite.wsgi.save_snapshot). Anything other containers act on, like a job
+queued for the batch handler or a page exported to S3, has to wait for the
+version, or it may see a snapshot without the write or publish a write that
+never lands.
+
+While the write path is collecting, callbacks given to on_snapshot_commit
+are held until run_collected, once the version is committed, and dropped by
+discard_collected when the writes they came from are thrown away (a rerun
+after a conflict). Outside of it, e.g. under manage.py or runserver, they
+run when the transaction commits.
+"""
+from contextlib import contextmanager
+
+from django.db import transaction
+
+# Callbacks waiting for the version commit, None when not collecting
+collected = None
+
+
+def on_snapshot_commit(func):
+    def defer():
+        if collected is None:
+            func()
+        else:
+            collected.append(func)
+    transaction.on_commit(defer)
+
+
+@contextmanager
+def collecting():
+    """Hold on_snapshot_commit callbacks, whatever isn't run is dropped on exit."""
+    global collected
+    collected = []
+    try:
+        yield
+    finally:
+        collected = None
+
+
+def discard_collected():
+    if collected is not None:
+        collected.clear()
+
+
+def run_collected():
+    """Run the held callbacks, the version they waited for is committed."""
+    if not collected:
+        return
+    funcs = list(collected)
+    collected.clear()
+    for func in funcs:
+        try:
+            func()
+        except Exception as e:
+            # The write is committed either way, don't fail its response
+            print(f'Snapshot commit callback failed: {e}')
@@ -0,0 +1,77 @@
+"""
+Page level deltas for the SQLite snapshot.
+
+A delta holds every page that differs from a base snapshot plus the new page
+count, so the current database can be rebuilt as base + delta + delta ...
+without shipping the whole file after every edit.
+"""
+import hashlib
+import struct
+import zlib
+
+DELTA_MAGIC = b'SQLITEDELTA1'
+HEADER = struct.Struct('>II')  # page size, page count
+PAGE_NUMBER = struct.Struct('>I')
+
+
+def get_page_size(db_path) -> int:
+    with open(db_path, 'rb') as f:
+        header = f.read(18)
+    # Stored big endian at offset 16, the value 1 means 65536
+    page_size = int.from_bytes(header[16:18], 'big')
+    return 65536 if page_size == 1 else page_size
+
+
+def hash_pages(db_path) -> list[bytes]:
+    page_size = get_page_size(db_path)
+    hashes = []
+    with open(db_path, 'rb') as f:
+        while page := f.read(page_size):
+            hashes.append(hashlib.blake2b(page, digest_size=16).digest())
+    return hashes
+
+
+def make_delta(db_path, base_hashes: list[bytes]) -> tuple[bytes, list[bytes]]:
+    """
+    Returns the compressed delta from the pages described by base_hashes to
+    the file at db_path, along with the page hashes of that file.
+    """
+    page_size = get_page_size(db_path)
+    hashes = []
+    body = bytearray()
+    with open(db_path, 'rb') as f:
+        page_number = 0
+        while page := f.read(page_size):
+            page_hash = hashlib.blake2b(page, digest_size=16).digest()
+            hashes.append(page_hash)
+            if page_number >= len(base_hashes) or base_hashes[page_number] != page_hash:
+                body += PAGE_NUMBER.pack(page_number) + page
+            page_number += 1
+    delta = DELTA_MAGIC + HEADER.pack(page_size, len(hashes)) + body
+    return zlib.compress(delta), hashes
+
+
+def read_delta(delta: bytes) -> tuple[int, int, dict[int, bytes]]:
+    """Returns the page size, page count and changed pages of a delta."""
+    delta = zlib.decompress(delta)
+    if not delta.startswith(DELTA_MAGIC):
+        raise ValueError('Not a snapshot delta')
+    offset = len(DELTA_MAGIC)
+    page_size, page_count = HEADER.unpack_from(delta, offset)
+    offset += HEADER.size
+    pages = {}
+    while offset < len(delta):
+        (page_number,) = PAGE_NUMBER.unpack_from(delta, offset)
+        offset += PAGE_NUMBER.size
+        pages[page_number] = delta[offset:offset + page_size]
+        offset += page_size
+    return page_size, page_count, pages
+
+
+def apply_delta(db_path, delta: bytes):
+    page_size, page_count, pages = read_delta(delta)
+    with open(db_path, 'r+b') as f:
+        for page_number, page in pages.items():
+            f.seek(page_number * page_size)
+            f.write(page)
+        f.truncate(page_count * page_size)
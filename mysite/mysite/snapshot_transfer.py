@@ -0,0 +1,124 @@
+"""
+Compressed snapshot transfer.
+
+Snapshots are stored gzipped, with a small manifest in the object metadata
+(format and uncompressed size). Downloads fetch byte ranges concurrently and
+stream them through the decompressor straight into place, uploads compress
+as they stream parts to S3 so the whole file is never held in memory.
+Objects without a manifest are plain SQLite files and are copied as is.
+
+The compressor is fully flushed every BLOCK_SIZE bytes, so each block can
+also be inflated on its own from the offsets in the block index uploaded
+alongside every snapshot (see mysite.s3vfs).
+"""
+import json
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+CHUNK_SIZE = 8 * 1024 * 1024  # also the multipart part size, S3 needs >= 5MB
+BLOCK_SIZE = 256 * 1024
+GZIP_HEADER_SIZE = 10
+MAX_WORKERS = 8
+COMPRESSION_LEVEL = 3
+
+
+def get_index_key(object_key, version_id) -> str:
+    return f'{object_key}.index/{version_id}'
+
+
+def download_snapshot_object(s3_client, bucket_name, object_key, download_path, version_id=None):
+    head = s3_client.head_object(
+        Bucket=bucket_name, Key=object_key,
+        **({'VersionId': version_id} if version_id else {}))
+    # Pin every range to the same version even when asked for the latest
+    version_id = head.get('VersionId') or version_id
+    compressed = head.get('Metadata', {}).get('snapshot-format') == 'gzip'
+    size = head['ContentLength']
+    ranges = [(start, min(start + CHUNK_SIZE, size) - 1)
+              for start in range(0, size, CHUNK_SIZE)]
+
+    def get_range(byte_range):
+        extra_args = {'VersionId': version_id} if version_id else {}
+        response = s3_client.get_object(
+            Bucket=bucket_name, Key=object_key,
+            Range=f'bytes={byte_range[0]}-{byte_range[1]}', **extra_args)
+        return response['Body'].read()
+
+    decompressor = zlib.decompressobj(wbits=31) if compressed else None
+    temp_path = f'{download_path}.download'
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor, open(temp_path, 'wb') as f:
+        # Keep a bounded window of ranges in flight and write them in order
+        pending = []
+        for byte_range in ranges:
+            pending.append(executor.submit(get_range, byte_range))
+            if len(pending) >= MAX_WORKERS * 2:
+                write_chunk(f, pending.pop(0).result(), decompressor)
+        for future in pending:
+            write_chunk(f, future.result(), decompressor)
+        if decompressor:
+            f.write(decompressor.flush())
+    os.replace(temp_path, download_path)
+    return version_id
+
+
+def write_chunk(f, chunk, decompressor=None):
+    f.write(decompressor.decompress(chunk) if decompressor else chunk)
+
+
+def compressed_parts(db_path, block_offsets: list):
+    """
+    Yield gzip compressed parts of at least CHUNK_SIZE (bar the last),
+    appending the compressed offset of every block boundary to block_offsets.
+    """
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, wbits=31)
+    part = bytearray()
+    written = 0
+    block_offsets.append(GZIP_HEADER_SIZE)
+    with open(db_path, 'rb') as f:
+        while block := f.read(BLOCK_SIZE):
+            part += compressor.compress(block)
+            part += compressor.flush(zlib.Z_FULL_FLUSH)
+            block_offsets.append(written + len(part))
+            if len(part) >= CHUNK_SIZE:
+                written += len(part)
+                yield bytes(part)
+                part.clear()
+    part += compressor.flush()
+    yield bytes(part)
+
+
+def upload_snapshot_object(s3_client, bucket_name, object_key, db_path) -> str:
+    """Upload db_path gzipped and return the new S3 version id."""
+    upload = s3_client.create_multipart_upload(
+        Bucket=bucket_name, Key=object_key,
+        ContentType='application/gzip',
+        Metadata={
+            'snapshot-format': 'gzip',
+            'snapshot-size': str(os.path.getsize(db_path))
+        })
+    upload_id = upload['UploadId']
+    block_offsets = []
+    try:
+        parts = []
+        for part_number, part in enumerate(compressed_parts(db_path, block_offsets), start=1):
+            response = s3_client.upload_part(
+                Bucket=bucket_name, Key=object_key, UploadId=upload_id,
+                PartNumber=part_number, Body=part)
+            parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+        response = s3_client.complete_multipart_upload(
+            Bucket=bucket_name, Key=object_key, UploadId=upload_id,
+            MultipartUpload={'Parts': parts})
+    except Exception:
+        s3_client.abort_multipart_upload(
+            Bucket=bucket_name, Key=object_key, UploadId=upload_id)
+        raise
+    s3_client.put_object(
+        Bucket=bucket_name, Key=get_index_key(object_key, response['VersionId']),
+        Body=json.dumps({
+            'format': 'gzip',
+            'blockSize': BLOCK_SIZE,
+            'size': os.path.getsize(db_path),
+            'offsets': block_offsets
+        }))
+    return response['VersionId']
@@ -10,10 +10,14 @@ import os
 import logging
 import boto3
 import time
-import hashlib
+import sqlite3
+import uuid
+import json
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError, NoCredentialsError, PartialCredentialsError
+from http.cookies import SimpleCookie
 from django.core.management import call_command
 
-import django
 
 
 logger = logging.getLogger()
@@ -26,25 +30,140 @@ os.environ['DJANGO_SETTINGS_MODULE'] = 'mysite.settings'
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 print(sys.path)
 
+from mysite import metrics  # noqa: E402
+from mysite.changesets import ChangesetConflict, ChangesetRecorder, replay_changeset  # noqa: E402
+from mysite.churn import (get_attached_tables, get_churn_db_path, get_statement_table,  # noqa: E402
+                          move_churn_tables, replay_churn_changeset, split_changeset)
+from mysite.page_cache import PageCache, get_not_modified, rendering_version  # noqa: E402
+from mysite.settings import SNAPSHOT_CHURN_DB, SNAPSHOT_DB_PATH, str_to_bool  # noqa: E402
+from mysite.snapshot_commit import collecting, discard_collected, run_collected  # noqa: E402
+from mysite.snapshot_deltas import apply_delta, hash_pages, make_delta  # noqa: E402
+from mysite.snapshot_transfer import download_snapshot_object, upload_snapshot_object  # noqa: E402
 
-application = cast(WSGIApplication, get_wsgi_application())
 
-django.setup()
+# Once a base snapshot has this many deltas the next write uploads a fresh
+# base instead, so readers never have to replay a long chain.
+SNAPSHOT_MAX_DELTAS = int(os.environ.get('SNAPSHOT_MAX_DELTAS', 20))
+
+# Pessimistic mode: writers take a short-lived, fenced lease in the version
+# table and only the holder commits. Requests expected to write hold it
+# while they run, others only take it to upload what they wrote.
+SNAPSHOT_WRITE_LEASE = str_to_bool(os.environ.get('SNAPSHOT_WRITE_LEASE', 'False'))
+SNAPSHOT_LEASE_SECONDS = int(os.environ.get('SNAPSHOT_LEASE_SECONDS', 60))
+SNAPSHOT_LEASE_WAIT_SECONDS = int(os.environ.get('SNAPSHOT_LEASE_WAIT_SECONDS', 120))
+
+# Serve anonymous reads through the mysite.s3vfs backend, paging the
+# snapshot from S3, rather than downloading it first (needs apsw).
+SNAPSHOT_LAZY_READS = str_to_bool(os.environ.get('SNAPSHOT_LAZY_READS', 'False'))
+
+# Keep rendered anonymous responses per snapshot version (mysite.page_cache)
+SNAPSHOT_PAGE_CACHE = str_to_bool(os.environ.get('SNAPSHOT_PAGE_CACHE', 'False'))
+
+DOMAIN_NAME = 'example.com'
+
+# Churn tables (mysite.churn) are synced as their own chain of full
+# snapshots, at most this often. Statements written in between wait in the
+# container for the next write, session changes are always synced at once.
+SNAPSHOT_CHURN_SYNC_SECONDS = float(os.environ.get('SNAPSHOT_CHURN_SYNC_SECONDS', 0))
+CHURN_DB_PATH = get_churn_db_path(SNAPSHOT_DB_PATH)
+CHURN_OBJECT_KEY = 'db.sqlite3.churn'
+
+# Anonymous reads trust the local snapshot for this many seconds after it
+# was last known to be the latest version, without looking the version up.
+# A container's own writes count, so it always reads what it wrote.
+SNAPSHOT_READ_STALENESS_SECONDS = float(os.environ.get('SNAPSHOT_READ_STALENESS_SECONDS', 0))
+
+# The version looked up while the container started is reused by the first
+# invocation if it's at most this old, otherwise it's looked up again.
+SNAPSHOT_STARTUP_MAX_AGE = float(os.environ.get('SNAPSHOT_STARTUP_MAX_AGE', 1))
+
+# Snapshot currently on local disk in this (possibly warm) container, as
+# returned by get_latest_version, plus its page hashes once computed and
+# when (time.monotonic) it was last known to be the latest version.
+# Cleared whenever SNAPSHOT_DB_PATH may no longer match that version so the
+# next invocation downloads it again.
+local_snapshot = {'s3VersionId': None, 'version': None,
+                  'deltas': [], 'pages': None, 'confirmedAt': None}
+
+# Churn file on local disk: the churn version it was downloaded or uploaded
+# as, plus the statements written on top of it that haven't been synced.
+local_churn = {'s3VersionId': None, 'version': None,
+               'pending': [], 'syncedAt': 0.0}
+
+
+page_cache = PageCache(f'{SNAPSHOT_DB_PATH}.pages')
+
+
+# Pooled boto3 clients, created once per container on the startup pool.
+startup_executor = ThreadPoolExecutor(max_workers=4)
+clients = {}
+
+
+def create_client(service_name):
+    # boto3's default session isn't thread safe, give each client its own
+    return boto3.session.Session().client(service_name)
+
+
+def get_client(service_name):
+    if service_name not in clients:
+        clients[service_name] = startup_executor.submit(create_client, service_name)
+    return clients[service_name].result()
+
+
+def set_local_snapshot(s3_version_id=None, version=None, deltas=None, pages=None,
+                       confirmed_at=None):
+    local_snapshot['s3VersionId'] = s3_version_id
+    local_snapshot['version'] = version
+    local_snapshot['deltas'] = deltas or []
+    local_snapshot['pages'] = pages
+    local_snapshot['confirmedAt'] = confirmed_at
+
+
+def is_local_snapshot_current(latest_version_info) -> bool:
+    if not latest_version_info or not os.path.exists(SNAPSHOT_DB_PATH):
+        return False
+    return (local_snapshot['s3VersionId'] == latest_version_info['s3VersionId']
+            and local_snapshot['version'] == latest_version_info['version']
+            and local_snapshot['deltas'] == latest_version_info['deltas'])
+
+
+def set_local_churn(s3_version_id=None, version=None):
+    local_churn['s3VersionId'] = s3_version_id
+    local_churn['version'] = version
+
+
+def is_local_churn_current(latest_churn_info) -> bool:
+    return (os.path.exists(CHURN_DB_PATH)
+            and local_churn['s3VersionId'] == latest_churn_info['s3VersionId']
+            and local_churn['version'] == latest_churn_info['version'])
+
+
+def get_local_snapshot_age():
+    """Seconds since the local snapshot was last known to be the latest, or None."""
+    if local_snapshot['confirmedAt'] is None or not os.path.exists(SNAPSHOT_DB_PATH):
+        return None
+    return time.monotonic() - local_snapshot['confirmedAt']
+
+
+def get_local_pages():
+    """Page hashes of the local snapshot, computed once per version."""
+    if local_snapshot['pages'] is None:
+        local_snapshot['pages'] = hash_pages(SNAPSHOT_DB_PATH)
+    return local_snapshot['pages']
 
 
 def download_db_from_s3(version_id=None):
-    s3_client = boto3.client('s3')
+    s3_client = get_client('s3')
     bucket_name = os.environ['BUCKET_NAME']
     object_key = 'db.sqlite3'
-    download_path = '/tmp/db.sqlite3'
-    extra_args = {"VersionId": version_id} if version_id else {}
+    download_path = SNAPSHOT_DB_PATH
 
     print(
         f"Downloading {object_key} from S3 bucket {bucket_name} to {download_path}")
-    print(f"Extra args: {extra_args}")
+    print(f"Version: {version_id}")
     try:
-        print(s3_client.download_file(bucket_name, object_key,
-                                      download_path, ExtraArgs=extra_args))
+        download_snapshot_object(s3_client, bucket_name, object_key,
+                                 download_path, version_id)
         print('Successfully downloaded')
         return True
     except Exception:
@@ -52,11 +171,10 @@ def download_db_from_s3(version_id=None):
         return False
 
 
-def delete_s3_version(version_id):
+def delete_s3_version(version_id, object_key='db.sqlite3'):
     try:
-        s3_client = boto3.client('s3')
+        s3_client = get_client('s3')
         bucket_name = os.environ['BUCKET_NAME']
-        object_key = 'db.sqlite3'
         # Delete the specific version of the object
         response = s3_client.delete_object(
             Bucket=bucket_name,
@@ -77,19 +195,125 @@ def delete_s3_version(version_id):
         print(f"An unexpected error occurred: {e}")
 
 
-def upload_db_to_s3(db_path='/tmp/db.sqlite3'):
-    s3_client = boto3.client('s3')
+def download_delta_from_s3(object_key) -> bytes:
+    s3_client = get_client('s3')
+    bucket_name = os.environ['BUCKET_NAME']
+    print(f"Downloading delta {object_key} from S3 bucket {bucket_name}")
+    return s3_client.get_object(Bucket=bucket_name, Key=object_key)['Body'].read()
+
+
+def upload_delta_to_s3(delta: bytes, version) -> str:
+    s3_client = get_client('s3')
+    bucket_name = os.environ['BUCKET_NAME']
+    # Unique per upload so conflicting writers never overwrite each other
+    object_key = f'db.sqlite3.deltas/{version:010d}-{uuid.uuid4().hex}'
+    s3_client.put_object(Bucket=bucket_name, Key=object_key, Body=delta)
+    return object_key
+
+
+def delete_delta_from_s3(object_key):
+    try:
+        s3_client = get_client('s3')
+        bucket_name = os.environ['BUCKET_NAME']
+        s3_client.delete_object(Bucket=bucket_name, Key=object_key)
+        print(f"Successfully deleted delta {object_key} from bucket {bucket_name}.")
+    except Exception as e:
+        print(f"An unexpected error occurred: {e}")
+
+
+def download_snapshot(latest_version_info) -> bool:
+    """
+    Rebuild SNAPSHOT_DB_PATH as the base snapshot plus its chain of deltas.
+
+    A warm container that already has the same base only fetches the deltas
+    it hasn't applied yet. Returns False if the base snapshot doesn't exist.
+    """
+    if is_local_snapshot_current(latest_version_info):
+        print(
+            f'Local snapshot already at version {latest_version_info["version"]}, skipping download')
+        return True
+
+    from django.db import connections
+
+    # Open connections would keep reading the file we're about to replace
+    connections.close_all()
+    return fetch_snapshot(latest_version_info)
+
+
+@metrics.timed('SnapshotDownload')
+def fetch_snapshot(latest_version_info) -> bool:
+    """download_snapshot for when no Django connection can be open yet."""
+    s3_version_id = latest_version_info['s3VersionId'] if latest_version_info else None
+    version = latest_version_info['version'] if latest_version_info else 0
+    deltas = latest_version_info['deltas'] if latest_version_info else []
+    applied = local_snapshot['deltas']
+    if (s3_version_id and local_snapshot['s3VersionId'] == s3_version_id
+            and deltas[:len(applied)] == applied
+            and os.path.exists(SNAPSHOT_DB_PATH)):
+        pending = deltas[len(applied):]
+        set_local_snapshot()
+    else:
+        set_local_snapshot()
+        if not download_db_from_s3(s3_version_id):
+            return False
+        pending = deltas
+
+    for object_key in pending:
+        apply_delta(SNAPSHOT_DB_PATH, download_delta_from_s3(object_key))
+    set_local_snapshot(s3_version_id, version, deltas)
+    return True
+
+
+@metrics.timed('Upload')
+def upload_snapshot(latest_version_info, new_version, base_pages=None) -> dict:
+    """
+    Ship the local DB as a delta against latest_version_info, or as a new base
+    snapshot when there is nothing to diff against or the chain is too long.
+    """
+    deltas = latest_version_info['deltas'] if latest_version_info else []
+    if base_pages is not None and latest_version_info and len(deltas) < SNAPSHOT_MAX_DELTAS:
+        delta, pages = make_delta(SNAPSHOT_DB_PATH, base_pages)
+        # A delta nearly as big as the DB is better spent on a new base
+        if len(delta) < os.path.getsize(SNAPSHOT_DB_PATH) // 2:
+            object_key = upload_delta_to_s3(delta, new_version)
+            print(f'Uploaded delta {object_key} ({len(delta)} bytes)')
+            return {
+                's3VersionId': latest_version_info['s3VersionId'],
+                'deltas': [*deltas, object_key],
+                'pages': pages,
+                'deltaKey': object_key
+            }
+
+    print('Uploading full snapshot')
+    return {
+        's3VersionId': upload_db_to_s3(),
+        'deltas': [],
+        'pages': None,
+        'deltaKey': None
+    }
+
+
+def discard_snapshot_upload(upload):
+    if upload is None:
+        return
+    if upload['deltaKey']:
+        delete_delta_from_s3(upload['deltaKey'])
+    else:
+        delete_s3_version(upload['s3VersionId'])
+
+
+def upload_db_to_s3(db_path=SNAPSHOT_DB_PATH):
+    s3_client = get_client('s3')
     bucket_name = os.environ['BUCKET_NAME']
     object_key = 'db.sqlite3'
-    s3_client.upload_file(db_path, bucket_name, object_key)
-    head_response = s3_client.head_object(Bucket=bucket_name, Key=object_key)
-    return head_response['VersionId']
+    return upload_snapshot_object(s3_client, bucket_name, object_key, db_path)
 
 
+@metrics.timed('VersionLookup')
 def get_latest_version(domain_name: str) -> dict:
     try:
 
-        dynamodb_client = boto3.client('dynamodb')
+        dynamodb_client = get_client('dynamodb')
         table_name = os.environ['TABLE_NAME']
         response = dynamodb_client.query(
             TableName=table_name,
@@ -108,7 +332,8 @@ def get_latest_version(domain_name: str) -> dict:
                 'domainName': item['domainName']['S'],
                 's3Path': item['s3Path']['S'],
                 'version': int(item['version']['N']),
-                's3VersionId': item['s3VersionId']['S']
+                's3VersionId': item['s3VersionId']['S'],
+                'deltas': [delta['S'] for delta in item.get('deltas', {}).get('L', [])]
             }
         else:
             logger.debug("No items found")
@@ -118,31 +343,59 @@ def get_latest_version(domain_name: str) -> dict:
         raise
 
 
-def update_version(domain_name, new_version, s3_version_id, expected_version=None):
+@metrics.timed('VersionCommit')
+def update_version(domain_name, new_version, s3_version_id, expected_version=None, deltas=None, lease=None,
+                   s3_path='db.sqlite3'):
     try:
 
-        dynamodb_client = boto3.client('dynamodb')
+        dynamodb_client = get_client('dynamodb')
         table_name = os.environ['TABLE_NAME']
-        dynamodb_client.put_item(
-            TableName=table_name,
-            Item={
+        put = {
+            'TableName': table_name,
+            'Item': {
                 'domainName': {'S': domain_name},
-                's3Path': {'S': 'db.sqlite3'},
+                's3Path': {'S': s3_path},
                 'version': {'N': str(new_version)},
-                's3VersionId': {'S': s3_version_id}
+                's3VersionId': {'S': s3_version_id},
+                'deltas': {'L': [{'S': delta} for delta in deltas or []]}
             },
-            ConditionExpression='attribute_not_exists(domainName) OR version < :expected_version',
-            ExpressionAttributeValues={
+            'ConditionExpression': 'attribute_not_exists(domainName) OR version < :expected_version',
+            'ExpressionAttributeValues': {
                 ':expected_version': {'N': str(expected_version)}
             }
-        )
+        }
+        if lease:
+            # Fenced commit: only lands if we still hold the lease we took,
+            # so a writer whose lease expired can't overwrite its successor.
+            dynamodb_client.transact_write_items(TransactItems=[
+                {'Put': put},
+                {'ConditionCheck': {
+                    'TableName': table_name,
+                    'Key': lease_key(domain_name),
+                    'ConditionExpression': 'holder = :holder AND fence = :fence',
+                    'ExpressionAttributeValues': {
+                        ':holder': {'S': lease['holder']},
+                        ':fence': {'N': str(lease['fence'])}
+                    }
+                }}
+            ])
+        else:
+            dynamodb_client.put_item(**put)
         logger.debug(
             f"Updated version: {new_version} for domain: {domain_name}")
         return {
             'domainName': domain_name,
             'version': new_version,
-            's3VersionId': s3_version_id
+            's3VersionId': s3_version_id,
+            'deltas': deltas or []
         }
+    except dynamodb_client.exceptions.TransactionCanceledException as e:
+        logger.error(f"Version conflict: {str(e)}")
+        reasons = e.response.get('CancellationReasons', [])
+        if len(reasons) > 1 and reasons[1].get('Code') == 'ConditionalCheckFailed':
+            # The fence moved on, no retry can land until we lease again
+            raise WriteLeaseLost('Write lease lost, take it again.')
+        raise Exception('Version conflict, try again.')
     except dynamodb_client.exceptions.ConditionalCheckFailedException as e:
         logger.error(f"Version conflict: {str(e)}")
         raise Exception('Version conflict, try again.')
@@ -151,9 +404,167 @@ def update_version(domain_name, new_version, s3_version_id, expected_version=Non
         raise
 
 
+class WriteLeaseLost(Exception):
+    pass
+
+
+def lease_key(domain_name) -> dict:
+    # Kept under its own partition so get_latest_version never sees it
+    return {'domainName': {'S': f'{domain_name}#lease'}, 'version': {'N': '0'}}
+
+
+@metrics.timed('LeaseWait')
+def acquire_write_lease(domain_name) -> dict:
+    """
+    Wait for and take the write lease for domain_name.
+
+    Every acquisition bumps the lease's fence token, which update_version
+    checks when committing. Raises if the lease can't be had within
+    SNAPSHOT_LEASE_WAIT_SECONDS.
+    """
+    dynamodb_client = get_client('dynamodb')
+    table_name = os.environ['TABLE_NAME']
+    holder = uuid.uuid4().hex
+    deadline = time.time() + SNAPSHOT_LEASE_WAIT_SECONDS
+    delay = 0.05
+    while True:
+        now = time.time()
+        try:
+            response = dynamodb_client.update_item(
+                TableName=table_name,
+                Key=lease_key(domain_name),
+                UpdateExpression='SET holder = :holder, expiresAt = :expires_at ADD fence :one',
+                ConditionExpression='attribute_not_exists(holder) OR expiresAt < :now',
+                ExpressionAttributeValues={
+                    ':holder': {'S': holder},
+                    ':expires_at': {'N': str(now + SNAPSHOT_LEASE_SECONDS)},
+                    ':now': {'N': str(now)},
+                    ':one': {'N': '1'}
+                },
+                ReturnValues='UPDATED_NEW'
+            )
+            fence = int(response['Attributes']['fence']['N'])
+            print(f'Acquired write lease {holder} with fence {fence}')
+            return {'holder': holder, 'fence': fence}
+        except dynamodb_client.exceptions.ConditionalCheckFailedException:
+            if now >= deadline:
+                raise Exception('Timed out waiting for the write lease')
+            print(f'Write lease held elsewhere, waiting {delay} seconds')
+            time.sleep(delay)
+            delay = min(delay * 2, 1)
+
+
+def release_write_lease(domain_name, lease):
+    try:
+        dynamodb_client = get_client('dynamodb')
+        dynamodb_client.update_item(
+            TableName=os.environ['TABLE_NAME'],
+            Key=lease_key(domain_name),
+            UpdateExpression='REMOVE holder, expiresAt',
+            ConditionExpression='holder = :holder',
+            ExpressionAttributeValues={':holder': {'S': lease['holder']}}
+        )
+        print(f'Released write lease {lease["holder"]}')
+    except Exception as e:
+        # It expired and someone else took it, nothing to release
+        logger.error(f"Error releasing write lease: {str(e)}")
+
+
+def churn_domain(domain_name) -> str:
+    # Its own partition, so the churn chain never races the content one
+    return f'{domain_name}#churn'
+
+
+@metrics.timed('ChurnDownload')
+def download_churn_snapshot(latest_churn_info):
+    """
+    Bring the local churn file up to latest_churn_info, replaying the
+    statements that haven't been synced yet on top of it.
+    """
+    if latest_churn_info is None or is_local_churn_current(latest_churn_info):
+        return
+    from django.db import connections
+
+    connections.close_all()
+    print(f'Downloading churn version {latest_churn_info["version"]}')
+    download_snapshot_object(get_client('s3'), os.environ['BUCKET_NAME'], CHURN_OBJECT_KEY,
+                             CHURN_DB_PATH, latest_churn_info['s3VersionId'])
+    set_local_churn(latest_churn_info['s3VersionId'], latest_churn_info['version'])
+    if local_churn['pending']:
+        replay_churn_changeset(local_churn['pending'])
+
+
+def take_churn_statements(changeset):
+    """Set the churn statements of changeset aside as pending, returning the rest."""
+    if not SNAPSHOT_CHURN_DB or changeset is None:
+        return changeset
+    changeset, churn_changeset = split_changeset(changeset, get_attached_tables())
+    local_churn['pending'].extend(churn_changeset)
+    return changeset
+
+
+def discard_churn_statements(domain_name, keep):
+    """
+    Drop the pending churn statements after the first keep, e.g. before a
+    request runs again, and rebuild the churn file without them.
+    """
+    if not SNAPSHOT_CHURN_DB or len(local_churn['pending']) == keep:
+        return
+    del local_churn['pending'][keep:]
+    set_local_churn()
+    download_churn_snapshot(get_latest_version(churn_domain(domain_name)))
+
+
+@metrics.timed('ChurnSync')
+def sync_churn_snapshot(domain_name, force=False):
+    """
+    Upload the local churn file as the next churn version if it has pending
+    statements, or regardless when force is set (e.g. after migrate moved
+    tables in or out of it).
+
+    Conflicts are resolved by downloading the newer version and replaying
+    the pending statements, except on force where the local file wins. The
+    content snapshot is already committed by now, so a failed sync only
+    logs, the statements stay pending for the next write.
+    """
+    pending = local_churn['pending']
+    if not force:
+        if not pending:
+            return
+        if (time.monotonic() - local_churn['syncedAt'] < SNAPSHOT_CHURN_SYNC_SECONDS
+                and 'django_session' not in map(get_statement_table, pending)):
+            print(f'Deferring sync of {len(pending)} churn statements')
+            return
+
+    s3_client = get_client('s3')
+    bucket_name = os.environ['BUCKET_NAME']
+    for retry in range(10):
+        s3_version_id = None
+        try:
+            latest_churn_info = get_latest_version(churn_domain(domain_name))
+            if not force:
+                download_churn_snapshot(latest_churn_info)
+            current_version = latest_churn_info['version'] if latest_churn_info else 0
+            s3_version_id = upload_snapshot_object(s3_client, bucket_name, CHURN_OBJECT_KEY,
+                                                   CHURN_DB_PATH)
+            update_version(churn_domain(domain_name), current_version + 1, s3_version_id,
+                           current_version, s3_path=CHURN_OBJECT_KEY)
+            set_local_churn(s3_version_id, current_version + 1)
+            print(f'Synced {len(pending)} churn statements as churn version {current_version + 1}')
+            local_churn['pending'] = []
+            local_churn['syncedAt'] = time.monotonic()
+            return
+        except Exception as e:
+            logger.error(f'Churn sync conflict: {str(e)}')
+            if s3_version_id:
+                delete_s3_version(s3_version_id, CHURN_OBJECT_KEY)
+            time.sleep(0.05 * (retry + 1))
+    logger.error(f'Giving up syncing churn, {len(pending)} statements stay pending')
+
+
 def clear_version_table():
     dynamodb = boto3.resource('dynamodb')
-    dynamodb_client = boto3.client('dynamodb')
+    dynamodb_client = get_client('dynamodb')
     table_name = os.environ['TABLE_NAME']
     try:
         # Scan the table to get all the items
@@ -184,6 +595,186 @@ def clear_version_table():
         print(e)
 
 
+class SnapshotChangeTracker:
+    """
+    Detects commits to the local snapshot without reading the file.
+
+    SQLite bumps PRAGMA data_version on this side connection whenever any
+    other connection (i.e. Django's) commits a change, so the check costs
+    the same whatever the size of the database.
+    """
+
+    def __init__(self, db_path=SNAPSHOT_DB_PATH):
+        self.connection = sqlite3.connect(db_path, isolation_level=None)
+        self.data_version = self.get_data_version()
+
+    def get_data_version(self) -> int:
+        return self.connection.execute('PRAGMA data_version').fetchone()[0]
+
+    def has_changed(self) -> bool:
+        return self.get_data_version() != self.data_version
+
+    def close(self):
+        self.connection.close()
+
+
+def use_read_only_db(read_only: bool):
+    from django.db import connections
+
+    # Connections opened in the other mode must not be reused.
+    connections.close_all()
+    connections['default'].settings_dict['NAME'] = (
+        f'file:{SNAPSHOT_DB_PATH}?mode=ro&immutable=1' if read_only else SNAPSHOT_DB_PATH)
+
+
+def is_read_only_request(event: dict[str, Any]) -> bool:
+    """Anonymous GET/HEAD requests never need to save anything back."""
+    if 'command' in event or event.get('httpMethod') not in ['GET', 'HEAD']:
+        return False
+    # Logged in users (e.g. the wagtail admin) can write on a GET, so keep
+    # them on the full sync path.
+    headers = {key.lower(): value for key,
+               value in (event.get('headers') or {}).items()}
+    cookies = SimpleCookie(headers.get('cookie', ''))
+    return settings.SESSION_COOKIE_NAME not in cookies
+
+
+def serve_cached_page(event: dict[str, Any], context: dict[str, Any], version_info,
+                      handler) -> dict[str, Any]:
+    """Serve a read only request from the page cache, or by handler and cache it."""
+    if not version_info or version_info['version'] is None:
+        return handler(event, context)
+    with rendering_version(version_info):
+        if not SNAPSHOT_PAGE_CACHE:
+            return handler(event, context)
+        response = page_cache.get(version_info, event)
+        if response is not None:
+            print('Serving page from the page cache')
+            return get_not_modified(event, response) or response
+        response = handler(event, context)
+        if response is not None:
+            page_cache.put(version_info, event, response)
+        return response
+
+
+def handle_read_only_request(event: dict[str, Any], context: dict[str, Any]) -> dict[str, Any]:
+    print('Performing read only Web Request')
+    metrics.set_property('RequestType', 'ReadOnly')
+    return serve_cached_page(event, context, local_snapshot, render_read_only_request)
+
+
+class ReadOnlyWriteAttempt(Exception):
+    """A read only request tried to write, it has to run on the write path."""
+
+
+def run_read_only_request(event: dict[str, Any], context: dict[str, Any]) -> dict[str, Any]:
+    """
+    Run the request on the read only default connection. Django answers a
+    failed write with an error page, so a request that tried to write raises
+    ReadOnlyWriteAttempt instead of returning it.
+    """
+    from django.db import OperationalError, connection
+
+    write_attempts = []
+
+    def record_write_attempts(execute, sql, params, many, execute_context):
+        try:
+            return execute(sql, params, many, execute_context)
+        except OperationalError as e:
+            if 'readonly database' in str(e):
+                write_attempts.append(sql)
+            raise
+
+    with metrics.phase('Request'), connection.execute_wrapper(record_write_attempts):
+        response = lambda_web_handler(event, context)
+    if write_attempts:
+        raise ReadOnlyWriteAttempt(write_attempts[0][:100])
+    return response
+
+
+def render_read_only_request(event: dict[str, Any], context: dict[str, Any]) -> dict[str, Any]:
+    use_read_only_db(True)
+    try:
+        # Any write attempt raises "attempt to write a readonly database"
+        return run_read_only_request(event, context)
+    finally:
+        use_read_only_db(False)
+
+
+def fall_back_to_write_path(write_attempt: ReadOnlyWriteAttempt) -> bool:
+    """Note a read only request rerunning on the write path, returns read_only."""
+    print(f'Read only request tried to write, running it on the write path: {write_attempt}')
+    metrics.add('ReadOnlyFallback', 1, 'Count')
+    return False
+
+
+def handle_lazy_read_only_request(event: dict[str, Any], context: dict[str, Any],
+                                  latest_version_info) -> dict[str, Any]:
+    """
+    Serve a read only request straight from the S3 snapshot through the s3vfs
+    backend. Returns None if that version can't be paged lazily.
+    """
+    def render(event, context):
+        return render_lazy_read_only_request(event, context, latest_version_info)
+
+    return serve_cached_page(event, context, latest_version_info, render)
+
+
+def render_lazy_read_only_request(event: dict[str, Any], context: dict[str, Any],
+                                  latest_version_info) -> dict[str, Any]:
+    from django.db import connections
+    from django.db.utils import load_backend
+    from mysite.s3vfs.vfs import SnapshotNotPageable, set_snapshot
+
+    try:
+        set_snapshot(get_client('s3'), os.environ['BUCKET_NAME'], 'db.sqlite3',
+                     latest_version_info['s3VersionId'], latest_version_info['deltas'])
+    except (SnapshotNotPageable, ClientError) as e:
+        print(f'Snapshot can not be paged lazily: {e}')
+        return None
+
+    print('Performing lazy read only Web Request')
+    metrics.set_property('RequestType', 'Lazy')
+    connections.close_all()
+    default_connection = connections['default']
+    lazy_connection = load_backend('mysite.s3vfs').DatabaseWrapper(
+        {**default_connection.settings_dict, 'ENGINE': 'mysite.s3vfs', 'NAME': 'db.sqlite3'},
+        'default')
+    connections['default'] = lazy_connection
+    try:
+        return run_read_only_request(event, context)
+    finally:
+        lazy_connection.close()
+        connections['default'] = default_connection
+
+
+def move_churn_tables_locally(to_churn):
+    """
+    Move the churn tables into (True) or out of (False) the local churn file,
+    or with None start over without one.
+    """
+    from django.db import connections
+
+    connections.close_all()
+    if to_churn is None:
+        if os.path.exists(CHURN_DB_PATH):
+            os.remove(CHURN_DB_PATH)
+        set_local_churn()
+        local_churn['pending'] = []
+    else:
+        move_churn_tables(SNAPSHOT_DB_PATH, to_churn)
+
+
+def run_recording_changeset(action, event: dict[str, Any], context: dict[str, Any]):
+    """Run the action, recording the rows it commits as a changeset."""
+    from django.db import connection
+
+    recorder = ChangesetRecorder()
+    with connection.execute_wrapper(recorder):
+        response = action(event, context)
+    return recorder.statements, response
+
+
 def createSingleLogEvent(event: dict[str, Any], response: dict[str, Any]):
     returnedEvent = {}
     for key in event:
@@ -195,30 +786,84 @@ def createSingleLogEvent(event: dict[str, Any], response: dict[str, Any]):
 
 
 def lambda_handler(event: dict[str, Any], context: dict[str, Any]) -> dict[str, Any]:
+    try:
+        with metrics.phase('Invocation'):
+            return handle_event(event, context)
+    finally:
+        if local_snapshot['version'] is not None:
+            metrics.set_property('SnapshotVersion', local_snapshot['version'])
+        if os.path.exists(SNAPSHOT_DB_PATH):
+            metrics.add('SnapshotSize', os.path.getsize(SNAPSHOT_DB_PATH), 'Bytes')
+        if SNAPSHOT_CHURN_DB and os.path.exists(CHURN_DB_PATH):
+            metrics.add('ChurnSize', os.path.getsize(CHURN_DB_PATH), 'Bytes')
+        metrics.flush()
+
+
+def handle_event(event: dict[str, Any], context: dict[str, Any]) -> dict[str, Any]:
+
+    if 'Records' in event:
+        with collecting():
+            return batch_handler(event, context)
 
-    domain_name = 'example.com'
+    domain_name = DOMAIN_NAME
+    read_only = is_read_only_request(event)
+
+    if SNAPSHOT_READ_STALENESS_SECONDS and read_only:
+        snapshot_age = get_local_snapshot_age()
+        if snapshot_age is not None and snapshot_age < SNAPSHOT_READ_STALENESS_SECONDS:
+            print(f'Local snapshot confirmed {snapshot_age:.3f} seconds ago, skipping version lookup')
+            metrics.add('SnapshotAge', round(snapshot_age, 3), 'Seconds')
+            if snapshot_age > SNAPSHOT_READ_STALENESS_SECONDS / 2:
+                start_version_refresh()
+            try:
+                return handle_read_only_request(event, context)
+            except ReadOnlyWriteAttempt as e:
+                read_only = fall_back_to_write_path(e)
 
     force_write = False
     #
     #  At the end of this we will have a new db or have fetched the latest
     #
-    print('Getting latest version')
-    latest_version_info = get_latest_version(domain_name)
+    lookup = take_startup_version() or take_refreshed_version()
+    if lookup:
+        latest_version_info = lookup['latest']
+        looked_up_at = lookup['lookedUpAt']
+    else:
+        print('Getting latest version')
+        looked_up_at = time.monotonic()
+        latest_version_info = get_latest_version(domain_name)
 
-    current_version = latest_version_info['version'] if latest_version_info else 0
     s3_version_id = latest_version_info['s3VersionId'] if latest_version_info else None
-    new_version = current_version + 1
-    if not download_db_from_s3(s3_version_id):
+
+    # Only worth it when the local snapshot would need a full download, a
+    # warm container on the same base just catches up on deltas.
+    if (SNAPSHOT_LAZY_READS and latest_version_info and read_only
+            and local_snapshot['s3VersionId'] != s3_version_id):
+        try:
+            response = handle_lazy_read_only_request(event, context, latest_version_info)
+        except ReadOnlyWriteAttempt as e:
+            read_only = fall_back_to_write_path(e)
+        else:
+            if response is not None:
+                return response
+
+    if download_snapshot(latest_version_info):
+        if latest_version_info:
+            local_snapshot['confirmedAt'] = looked_up_at
+    else:
         print(
-            f'Version {latest_version_info["s3VersionId"]} in DDB does not exist')
+            f'Version {s3_version_id} in DDB does not exist')
         # the version pointed to by ddb didn't exist, so just get latest
         if not download_db_from_s3():
 
             # and if that doesn't exist then just create a new one
-            # delete /tmp/db.sqlite3
-            os.remove('/tmp/db.sqlite3') if os.path.exists(
-                '/tmp/db.sqlite3') else None
-            sm = boto3.client('secretsmanager')
+            # delete the local snapshot
+            os.remove(SNAPSHOT_DB_PATH) if os.path.exists(
+                SNAPSHOT_DB_PATH) else None
+            if SNAPSHOT_CHURN_DB:
+                # Belongs to the churn chain cleared below
+                move_churn_tables_locally(None)
+            sm = get_client('secretsmanager')
             print('Empty DB Initialising')
             call_command('migrate')
             call_command('createsuperuser',
@@ -232,9 +877,46 @@ def lambda_handler(event: dict[str, Any], context: dict[str, Any]) -> dict[str,
             u.set_password(sm.get_secret_value(
                 SecretId="SUPER_USERPASSWORD")["SecretString"])
             u.save()
+            if SNAPSHOT_CHURN_DB:
+                move_churn_tables_locally(True)
             clear_version_table()
             force_write = True
 
+    if not force_write and read_only:
+        try:
+            return handle_read_only_request(event, context)
+        except ReadOnlyWriteAttempt as e:
+            read_only = fall_back_to_write_path(e)
+
+    if SNAPSHOT_CHURN_DB and not force_write:
+        download_churn_snapshot(get_latest_version(churn_domain(domain_name)))
+
+    # Requests expected to write run holding the lease, read only ones only
+    # get this far if they tried to. Others (e.g. logged in GETs) take it
+    # in handle_request if they turn out to have written.
+    if SNAPSHOT_WRITE_LEASE and (force_write or is_read_only_request(event)
+                                 or event.get('httpMethod') in ['POST', 'PUT', 'DELETE']
+                                 or event.get('command') == 'migrate'):
+        lease = acquire_write_lease(domain_name)
+        try:
+            # Nobody else can commit while we hold the lease, so catch up
+            # with whatever the previous holder wrote before running.
+            if not force_write:
+                latest_version_info = get_latest_version(domain_name)
+                download_snapshot(latest_version_info)
+            with collecting():
+                return handle_request(event, context, domain_name,
+                                      latest_version_info, force_write, lease)
+        finally:
+            release_write_lease(domain_name, lease)
+
+    with collecting():
+        return handle_request(event, context, domain_name,
+                              latest_version_info, force_write)
+
+
+def handle_request(event: dict[str, Any], context: dict[str, Any], domain_name,
+                   latest_version_info, force_write=False, lease=None) -> dict[str, Any]:
     action = None
     response = None
 
@@ -244,8 +926,13 @@ def lambda_handler(event: dict[str, Any], context: dict[str, Any]) -> dict[str,
             def action(event, context):
                 print('Performing DB Migration')
                 try:
+                    if SNAPSHOT_CHURN_DB:
+                        # Migrations can only alter tables in the snapshot
+                        move_churn_tables_locally(False)
                     call_command('makemigrations')
                     call_command('migrate')
+                    if SNAPSHOT_CHURN_DB:
+                        move_churn_tables_locally(True)
                     response = {'status': 'done'}
 
                 except e as Exception:
@@ -258,71 +945,383 @@ def lambda_handler(event: dict[str, Any], context: dict[str, Any]) -> dict[str,
         elif event['command'] == 'webrequest':
             def action(event, context): return (
                 print('Performing Web Request'),
-                (make_lambda_handler(
-                    application,
-                    binary_support=True)(event, context)))
+                lambda_web_handler(event, context))
     else:
         def action(event, context):
             print('Performing Web Request')
-            response = (make_lambda_handler(
-                application,
-                binary_support=True)(event, context))
+            response = lambda_web_handler(event, context)
             return response
 
-    file_hash_before = hashlib.md5(
-        open('/tmp/db.sqlite3', 'rb').read()).hexdigest()
-    print('File hashbefore is '+file_hash_before)
-    response = action(event, context)
+    metrics.set_property('RequestType', event.get('command') or event.get('httpMethod'))
+    # Pages as they were before the action so a write can ship as a delta
+    base_pages = None
+    if not force_write and is_local_snapshot_current(latest_version_info):
+        base_pages = get_local_pages()
 
-    if event['httpMethod'] in ['POST', 'PUT', 'DELETE'] or force_write:
-        print('Attempting to save back to S3')
-        retries = 0
-        RETRY_DELAY = [0.05, 0.05]
-        MAX_RETRIES = 100
+    change_tracker = SnapshotChangeTracker()
+    # Until we know the action left the file alone (or we uploaded it) the
+    # local copy can't be trusted to match any version.
+    snapshot_before = dict(local_snapshot)
+    set_local_snapshot()
+    churn_pending_before = len(local_churn['pending'])
+    # Migrations aren't replayable row changes, they always run again
+    changeset = None
+    try:
+        with metrics.phase('Request'):
+            if force_write:
+                response = action(event, context)
+            else:
+                changeset, response = run_recording_changeset(
+                    action, event, context)
+                changeset = take_churn_statements(changeset)
+        with metrics.phase('ChangeDetection'):
+            db_changed = change_tracker.has_changed()
+    finally:
+        change_tracker.close()
+    print(f'DB changed: {db_changed}')
 
-        file_hash_after = hashlib.md5(
-            open('/tmp/db.sqlite3', 'rb').read()).hexdigest()
+    if not db_changed:
+        set_local_snapshot(snapshot_before['s3VersionId'],
+                           snapshot_before['version'],
+                           snapshot_before['deltas'],
+                           snapshot_before['pages'],
+                           snapshot_before['confirmedAt'])
 
-        if file_hash_after != file_hash_before:
-            print('File has changed, attempting to save back')
-            while retries < MAX_RETRIES:
-                try:
+    # Whatever the method, logged in GETs (e.g. generating renditions) and
+    # read only requests that fell back here can write too
+    if force_write or db_changed:
+        print('File has changed, attempting to save back to S3')
 
-                    new_s3_version_id = upload_db_to_s3()
-                    update_version(domain_name, new_version,
-                                   new_s3_version_id, current_version)
-                    print('Uploaded successfully ' + new_s3_version_id)
-                    break  # Exit loop if successful
-                except Exception as e:
-                    logger.error(f'Version update conflict: {str(e)}')
-                    # delete failed  upload
-                    delete_s3_version(new_s3_version_id)
-                    retries += 1
-                    if retries >= MAX_RETRIES:
-                        logger.error('Max retries reached, aborting')
-                        raise
-                    # progressively increase retry delay using fibonacci sequence
+        def rerun():
+            nonlocal response
+            # Belonged to writes the rerun replaces
+            discard_collected()
+            if changeset is None:
+                response = action(event, context)
+                return None
+            print('Re-running request')
+            discard_churn_statements(domain_name, churn_pending_before)
+            statements, response = run_recording_changeset(
+                action, event, context)
+            return take_churn_statements(statements)
+
+        save_snapshot_leased(domain_name, latest_version_info, base_pages,
+                             changeset, rerun, lease)
+    else:
+        print('File unchanged, not saving back')
+    # Committed (or nothing to commit), so jobs and exports can see it
+    run_collected()
+
+    if SNAPSHOT_CHURN_DB:
+        sync_churn_snapshot(domain_name, force=force_write)
+
+    return response
+
+
+def save_snapshot_leased(domain_name, latest_version_info, base_pages, changeset, rerun, lease=None):
+    """
+    save_snapshot under the write lease, taking it for the upload if the
+    request ran without it. Writes committed meanwhile are caught up with
+    as on any conflict.
+    """
+    if lease or not SNAPSHOT_WRITE_LEASE:
+        return save_snapshot(domain_name, latest_version_info, base_pages, changeset, rerun, lease)
+    lease = acquire_write_lease(domain_name)
+    try:
+        return save_snapshot(domain_name, latest_version_info, base_pages, changeset, rerun, lease)
+    finally:
+        release_write_lease(domain_name, lease)
+
+
+def save_snapshot(domain_name, latest_version_info, base_pages, changeset, rerun, lease=None):
+    """
+    Upload the local DB as the version after latest_version_info, retrying on
+    conflict with a newer version.
+
+    After a conflict the newer snapshot is downloaded and the changeset is
+    replayed onto it. rerun() is only called when there is no changeset or
+    the replay genuinely conflicts, it must redo the work and return the new
+    changeset (or None).
+    """
+    current_version = latest_version_info['version'] if latest_version_info else 0
+    new_version = current_version + 1
+    retries = 0
+    RETRY_DELAY = [0.05, 0.05]
+    MAX_RETRIES = 100
+
+    while retries < MAX_RETRIES:
+        upload = None
+        try:
+
+            upload = upload_snapshot(
+                latest_version_info, new_version, base_pages)
+            update_version(domain_name, new_version,
+                           upload['s3VersionId'], current_version,
+                           upload['deltas'], lease)
+            # Committed, so it's the latest version as of now
+            set_local_snapshot(upload['s3VersionId'], new_version,
+                               upload['deltas'], upload['pages'], time.monotonic())
+            print('Uploaded successfully ' + upload['s3VersionId'])
+            metrics.add('Retries', retries, 'Count')
+            break  # Exit loop if successful
+        except Exception as e:
+            logger.error(f'Version update conflict: {str(e)}')
+            # delete failed  upload
+            discard_snapshot_upload(upload)
+            retries += 1
+            if retries >= MAX_RETRIES:
+                logger.error('Max retries reached, aborting')
+                metrics.add('Retries', retries, 'Count')
+                raise
+            # progressively increase retry delay using fibonacci sequence
+            print(
+                f"Retrying in {RETRY_DELAY[0]} seconds (retry {retries}/{MAX_RETRIES})")
+            time.sleep(RETRY_DELAY[0])
+            RETRY_DELAY = [RETRY_DELAY[0] +
+                           RETRY_DELAY[1], *RETRY_DELAY]
+
+            if isinstance(e, WriteLeaseLost):
+                # Our lease expired (or was taken) mid write, wait for a new
+                # one in place so the caller releases the right holder.
+                lease.update(acquire_write_lease(domain_name))
+
+            with metrics.phase('ConflictRetry'):
+                latest_version_info = get_latest_version(domain_name)
+
+                current_version = latest_version_info['version'] if latest_version_info else 0
+                new_version = current_version + 1
+                base_pages = None
+                if download_snapshot(latest_version_info) and latest_version_info:
+                    base_pages = get_local_pages()
+                set_local_snapshot()
+                if changeset is None:
+                    changeset = rerun()
+                    continue
+                # Apply what was written onto the newer snapshot and only redo
+                # the work if that genuinely conflicts.
+                try:
+                    replay_changeset(changeset)
                     print(
-                        f"Retrying in {RETRY_DELAY[0]} seconds (retry {retries}/{MAX_RETRIES})")
-                    time.sleep(RETRY_DELAY[0])
-                    RETRY_DELAY = [RETRY_DELAY[0] +
-                                   RETRY_DELAY[1], *RETRY_DELAY]
-
-                    latest_version_info = get_latest_version(domain_name)
-
-                    if latest_version_info:
-                        s3_version_id = latest_version_info['s3VersionId']
-                        current_version = latest_version_info['version']
-                        new_version = current_version + 1
-                    else:
-                        s3_version_id = None
-                        current_version = 0
-                    download_db_from_s3(s3_version_id)
-                    response = action(event, context)
+                        f'Replayed {len(changeset)} statements onto version {current_version}')
+                except ChangesetConflict as e:
+                    print(f'Changeset conflict: {e}')
+                    changeset = rerun()
+
+
+def run_queued_event(event: dict[str, Any], context: dict[str, Any]) -> dict[str, Any]:
+    """A queued API Gateway event, or a job queued by the app itself."""
+    if event.get('command') == 'renditions':
+        from cms.renditions import generate_renditions
+        generate_renditions(event['imageIds'])
+        return {'statusCode': 200}
+    if event.get('command') == 'refresh_pages':
+        from cms.models import run_page_refresh
+        run_page_refresh(event['pageIds'], event['paths'])
+        return {'statusCode': 200}
+    return lambda_web_handler(event, context)
+
+
+def run_queued_record(event: dict[str, Any], context: dict[str, Any]) -> dict[str, Any]:
+    """
+    A queued event in its own transaction, rolled back if it raises or
+    returns a 5xx: the record is redelivered, so none of its writes may be
+    uploaded with the batch (or recorded for a replay).
+    """
+    from django.core import signals
+    from django.db import close_old_connections, transaction
+
+    # Django closes the connection when the request finishes, which would
+    # roll the transaction back even when the record succeeded.
+    signals.request_started.disconnect(close_old_connections)
+    signals.request_finished.disconnect(close_old_connections)
+    try:
+        with transaction.atomic():
+            response = run_queued_event(event, context)
+            if response['statusCode'] >= 500:
+                transaction.set_rollback(True)
+            return response
+    finally:
+        signals.request_started.connect(close_old_connections)
+        signals.request_finished.connect(close_old_connections)
+
+
+def batch_handler(event: dict[str, Any], context: dict[str, Any]) -> dict[str, Any]:
+    """
+    Apply a batch of queued write events (e.g. an SQS batch whose record
+    bodies are the usual API Gateway events, or jobs like rendition
+    generation) to one downloaded snapshot, uploading it once for the whole
+    batch.
+
+    Returns each record's response along with SQS partial batch failures so
+    only the records that failed are redelivered.
+    """
+    domain_name = DOMAIN_NAME
+    records = event['Records']
+    print(f'Performing batch of {len(records)} requests')
+    metrics.set_property('RequestType', 'Batch')
+    metrics.add('BatchSize', len(records), 'Count')
+
+    def run_batch():
+        handler = run_queued_record
+        changeset, responses, failures = [], {}, []
+        for record in records:
+            try:
+                statements, response = run_recording_changeset(
+                    handler, json.loads(record['body']), context)
+                changeset.extend(statements)
+                responses[record['messageId']] = response
+                if response['statusCode'] >= 500:
+                    failures.append(record['messageId'])
+            except Exception as e:
+                logger.error(f"Record {record['messageId']} failed: {str(e)}")
+                failures.append(record['messageId'])
+        return take_churn_statements(changeset), responses, failures
+
+    lease = acquire_write_lease(domain_name) if SNAPSHOT_WRITE_LEASE else None
+    try:
+        latest_version_info = get_latest_version(domain_name)
+        if not download_snapshot(latest_version_info):
+            s3_version_id = latest_version_info['s3VersionId'] if latest_version_info else None
+            raise Exception(
+                f'Version {s3_version_id} in DDB does not exist')
+        base_pages = get_local_pages() if latest_version_info else None
+        if SNAPSHOT_CHURN_DB:
+            download_churn_snapshot(get_latest_version(churn_domain(domain_name)))
+
+        change_tracker = SnapshotChangeTracker()
+        snapshot_before = dict(local_snapshot)
+        set_local_snapshot()
+        churn_pending_before = len(local_churn['pending'])
+        try:
+            with metrics.phase('Request'):
+                changeset, responses, failures = run_batch()
+            with metrics.phase('ChangeDetection'):
+                db_changed = change_tracker.has_changed()
+        finally:
+            change_tracker.close()
+        print(f'DB changed: {db_changed}')
+
+        if db_changed:
+            def rerun():
+                nonlocal responses, failures
+                print('Re-running batch')
+                discard_collected()
+                discard_churn_statements(domain_name, churn_pending_before)
+                statements, responses, failures = run_batch()
+                return statements
+
+            save_snapshot(domain_name, latest_version_info, base_pages,
+                          changeset, rerun, lease)
         else:
-            print('File unchanged, not saving back')
+            set_local_snapshot(snapshot_before['s3VersionId'],
+                               snapshot_before['version'],
+                               snapshot_before['deltas'],
+                               snapshot_before['pages'],
+                               snapshot_before['confirmedAt'])
+        run_collected()
+        if SNAPSHOT_CHURN_DB:
+            sync_churn_snapshot(domain_name)
+    finally:
+        if lease:
+            release_write_lease(domain_name, lease)
 
-    return response
+    return {
+        'responses': responses,
+        'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failures]
+    }
+
+
+def prefetch_snapshot() -> dict:
+    """
+    Look up the latest version and fetch its snapshot into /tmp, on the
+    startup pool while Django sets up. With lazy reads on only the version
+    is looked up, the first request may not need the snapshot at all.
+    """
+    looked_up_at = time.monotonic()
+    latest_version_info = get_latest_version(DOMAIN_NAME)
+    if not SNAPSHOT_LAZY_READS:
+        fetch_snapshot(latest_version_info)
+    return {'latest': latest_version_info, 'lookedUpAt': looked_up_at,
+            'fetchedAt': time.monotonic()}
+
+
+def take_startup_version():
+    """
+    The prefetch_snapshot result from startup, once, if it's still fresh
+    enough. Returns None when the handler has to look the version up itself.
+    """
+    global startup_prefetch
+    if startup_prefetch is None:
+        return None
+    prefetch, startup_prefetch = startup_prefetch, None
+    try:
+        result = prefetch.result()
+    except Exception as e:
+        print(f'Startup prefetch failed: {e}')
+        return None
+    if time.monotonic() - result['fetchedAt'] > SNAPSHOT_STARTUP_MAX_AGE:
+        return None
+    print(f'Using version {result["latest"] and result["latest"]["version"]} looked up at startup')
+    return result
+
+
+def refresh_version() -> dict:
+    looked_up_at = time.monotonic()
+    # Timed here rather than as a VersionLookup phase, which would land in
+    # whichever invocation happens to be collecting metrics when it ends
+    latest = get_latest_version.__wrapped__(DOMAIN_NAME)
+    return {'latest': latest, 'lookedUpAt': looked_up_at,
+            'lookupTime': round((time.monotonic() - looked_up_at) * 1000, 3)}
+
+
+def start_version_refresh():
+    """
+    Look the version up on the startup pool while this request is served
+    from the local snapshot, so the first one past the staleness window
+    usually finds it done instead of waiting on DynamoDB.
+    """
+    global version_refresh
+    if version_refresh is None:
+        version_refresh = startup_executor.submit(refresh_version)
+
+
+def take_refreshed_version():
+    """
+    The background refresh result, once, if it finished and is still within
+    the staleness window. Returns None otherwise.
+    """
+    global version_refresh
+    if version_refresh is None or not version_refresh.done():
+        return None
+    refresh, version_refresh = version_refresh, None
+    try:
+        result = refresh.result()
+    except Exception as e:
+        print(f'Version refresh failed: {e}')
+        return None
+    if time.monotonic() - result['lookedUpAt'] > SNAPSHOT_READ_STALENESS_SECONDS:
+        return None
+    confirmed_at = local_snapshot['confirmedAt']
+    if confirmed_at is not None and result['lookedUpAt'] < confirmed_at:
+        # Older than what we know already, e.g. our own write since
+        return None
+    print(f'Using version {result["latest"] and result["latest"]["version"]} refreshed in the background')
+    metrics.add('VersionRefresh', result['lookupTime'])
+    return result
+
+
+# Cold start: create the clients and prefetch the snapshot on the startup
+# pool while Django sets up on this thread, all during the Lambda init phase.
+startup_prefetch = None
+version_refresh = None
+if 'AWS_LAMBDA_FUNCTION_NAME' in os.environ:
+    for service_name in ['dynamodb', 's3', 'secretsmanager']:
+        clients[service_name] = startup_executor.submit(create_client, service_name)
+    startup_prefetch = startup_executor.submit(prefetch_snapshot)
+
+with metrics.phase('DjangoSetup'):
+    application = cast(WSGIApplication, get_wsgi_application())
+lambda_web_handler = make_lambda_handler(application, binary_support=True)
 
 
 def createSampleWeb(path):